@@ -23,7 +23,6 @@ __version__ = '1.0.20240808'  # Major.Minor.Patch
 # 1718841600 # 2024/06/20 
 # TODO:
 #  md5sum command
-#  cp - retain file dates
 #  touch --ref= 
 #  handle /lib/ in mv properly (chop last /)
 #  tab-completion on lib/part
@@ -47,33 +46,254 @@ import machine
 import binascii
 
 
+class RingBuf: # Fixed-size byte ring holding one telnet client's unsent output (allocated once per connection)
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.head = 0 # offset of the next byte to send
+        self.n = 0    # number of bytes waiting
+
+    def put(self, data): # copy as much of data (a memoryview) in as fits, return the number of bytes taken
+        size = len(self.buf)
+        k = min(len(data), size - self.n)
+        t = (self.head + self.n) % size
+        a = min(k, size - t)
+        self.mv[t:t + a] = data[:a]
+        if k > a:
+            self.mv[:k - a] = data[a:k]
+        self.n += k
+        return k
+
+    def send(self, sock): # send the waiting bytes that are contiguous in the ring, return the number sent
+        if not self.n:
+            return 0
+        try:
+            sent = sock.send(self.mv[self.head:min(self.head + self.n, len(self.buf))]) or 0
+        except OSError as e:
+            if e.args[0] != 11: # EAGAIN: socket buffer full, try later
+                raise
+            sent = 0
+        self.head = (self.head + sent) % len(self.buf)
+        self.n -= sent
+        return sent
+
+
+class Session: # One shell user: the serial console (sock None) or a telnet client, each with its own line editor, cwd, terminal size and output ring
+    __slots__ = ('sock', 'addr', 'buf', 'm', 'n', 't', 'a', 'inq', 'line', 'cursor_pos', 'lastread', 'esc_seq', 'reading_esc', 'insert_mode', 'hist_loc', 'hs', 'cwd', 'w', 'h', 'term', 'term_ex')
+
+    def __init__(self, sock=None, addr='console', bufsize=0):
+        self.sock = sock
+        self.addr = addr
+        self.buf = RingBuf(bufsize) if sock else None # output waiting to be sent (the console writes straight to stdout)
+        self.m = 0                    # events sock is armed for in CustomIO._poll
+        self.n = 0 if sock else None  # telnet setup step (see _negotiate), None once done
+        self.t = time.ticks_ms()      # when that step is due
+        self.a = "" if sock else None # password typed so far, None once authenticated
+        self.inq = ""                 # keystrokes received but not yet through the line editor
+        self.line = ""
+        self.cursor_pos = 0
+        self.lastread = time.ticks_ms()
+        self.esc_seq = ""
+        self.reading_esc = False
+        self.insert_mode = True  # Default to insert mode
+        self.hist_loc = -1       # Start with the most recent command (has 1 added before use; 0 means last)
+        self.hs = None           # [prefix, [line numbers of distinct matches, newest first], next line to scan back from, last match text] for search_history
+        self.cwd = "/" if sock else os.getcwd()
+        self.w = 80  # terminal size and type
+        self.h = 24
+        self.term = ""
+        self.term_ex = ""
+
+
+class PipeSink: # One stage of a pipeline: what the stage before it prints is cut into lines and send() into this stage's generator (gen None: it doesn't read stdin, so they are dropped)
+    def __init__(self, cio, gen, nxt):
+        self.cio = cio
+        self.gen = gen
+        self.nxt = nxt  # the PipeSink this stage's own output goes to (None: the terminal)
+        self.part = ""  # unfinished last line
+
+    def write(self, chars):
+        if self.gen is None:
+            return
+        s = self.part + chars
+        i = 0
+        j = s.find('\n')
+        while j >= 0:
+            self._send(s[i:j + 1])
+            i = j + 1
+            j = s.find('\n', i)
+        self.part = s[i:]
+        if len(self.part) > 1024: # no newline in sight; hand it over as a chunk rather than grow
+            self._send(self.part)
+            self.part = ""
+
+    def _send(self, line):
+        if self.gen:
+            self.cio.pipe = self.nxt
+            try:
+                self.gen.send(line)
+            except StopIteration: # it has all it wants
+                self.gen = None
+            finally:
+                self.cio.pipe = self
+
+    def close(self, eof=True): # end of input: send() None so the stage can print its results
+        self.cio.pipe = self
+        try:
+            if eof:
+                if self.part:
+                    self._send(self.part)
+                self._send(None)
+        finally:
+            if self.gen:
+                self.gen.close()
+                self.gen = None
+            self.cio.pipe = self.nxt
+
+
+class Spool: # Lines a pipe stage must see all of before it can output any (sort): kept in RAM up to limit bytes, beyond that sorted runs go to temp files on flash and are merged back
+    def __init__(self, limit, key=None, reverse=False):
+        self.limit = limit
+        self.key = key
+        self.reverse = reverse
+        self.lines = []
+        self.size = 0
+        self.runs = [] # temp files, each one sorted
+
+    def add(self, line):
+        if not line.endswith('\n'):
+            line += '\n'
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size > self.limit:
+            self._spill()
+
+    def _spill(self):
+        self.lines.sort(key=self.key, reverse=self.reverse)
+        fn = "/.spool{}_{}.tmp".format(id(self), len(self.runs))
+        with open(fn, 'w') as f:
+            for line in self.lines:
+                f.write(line)
+        self.runs.append(fn)
+        self.lines = []
+        self.size = 0
+        gc.collect()
+
+    def __iter__(self): # everything added, in order
+        if not self.runs:
+            self.lines.sort(key=self.key, reverse=self.reverse)
+            for line in self.lines:
+                yield line
+            return
+        if self.lines:
+            self._spill()
+        files = [open(fn) for fn in self.runs]
+        try:
+            heads = [f.readline() for f in files]
+            keys = [self.key(h) if self.key else h for h in heads]
+            while True:
+                b = -1
+                for i in range(len(heads)):
+                    if heads[i] and (b < 0 or (keys[i] > keys[b] if self.reverse else keys[i] < keys[b])):
+                        b = i
+                if b < 0:
+                    break
+                yield heads[b]
+                heads[b] = files[b].readline()
+                keys[b] = self.key(heads[b]) if self.key and heads[b] else heads[b]
+        finally:
+            for f in files:
+                f.close()
+            self.close()
+
+    def close(self): # remove the temp files
+        for fn in self.runs:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        self.runs = []
+
+
+class BlockWriter: # Write-back buffer for > and >> and CustomIO.outfiles: output is collected into whole flash blocks, each written with one call. The rest goes at flush() (command end, close, or once it is 2s old)
+    def __init__(self, path, mode, bsize):
+        self.f = open(path, mode + 'b')
+        self.pos = os.stat(path)[6] if mode == 'a' else 0 # file offset the buffer starts at
+        self.buf = bytearray(bsize)
+        self.n = 0  # bytes in buf
+        self.t = 0  # ticks_ms when the oldest of them arrived
+
+    def write(self, chars): # str, or bytes (a memoryview of them is fine) as they are
+        data = memoryview(chars.encode('utf-8') if isinstance(chars, str) else chars)
+        if not self.n:
+            self.t = time.ticks_ms()
+        size = len(self.buf)
+        i = 0
+        while i < len(data):
+            room = size - (self.pos + self.n) % size # up to the next block boundary (the first block of an append tops up the last one in the file)
+            k = min(len(data) - i, room)
+            self.buf[self.n:self.n + k] = data[i:i + k]
+            self.n += k
+            i += k
+            if k == room:
+                self._out()
+        self.tick()
+
+    def _out(self):
+        if self.n:
+            self.f.write(memoryview(self.buf)[:self.n])
+            self.pos += self.n
+            self.n = 0
+            self.t = time.ticks_ms()
+
+    def tick(self): # the timer: don't sit on output for more than 2s
+        if self.n and time.ticks_diff(time.ticks_ms(), self.t) > 2000:
+            self.flush()
+
+    def flush(self):
+        self._out()
+        self.f.flush()
+
+    def close(self, eof=True):
+        try:
+            self.flush()
+        finally:
+            self.f.close()
+
+
 class CustomIO:
     def __init__(self):
         self.input_content = ""
         self.output_content = ""
         self.server_socket = None
-        self.sockets = []  # Dict of open TCP/IP client_socket connections for both input and output ['sock'] is the socket. ['addr'] is the client address. ['buf'] is the socket buffer. ['r'], ['w'], ['e'] is the state
+        self.sockets = []  # Session for each telnet client
         self.outfiles = []  # List of open file objects for output
         self.infiles = []   # List of open file objects for input
         #self.socket_buffers = {}  # Dictionary to store buffers for each socket
         self.history_file = "/.history.txt"  # Path to the history file
+        self.history_idx = "/.history.idx"   # 4-byte offset of the start of each history_file line (see _hist_len)
+        self._hist_n = None # number of history lines (None until the index has been checked)
+        self._hist_sz = 0   # history_file's size when it was
         self.shell=None     # telnetd sets this, so we can use get_desc
+        self.con = Session() # the serial console
+        self.cur = self.con  # the session whose keystrokes are being edited, or whose command is running: print() goes only to it
+        self.busy = None     # while a command runs, its session (only that one's input is read, for the command's own input() calls)
+        self._here = self.con # the session whose cwd os.getcwd() is
+        self.pipe = None     # PipeSink that print() output goes into while a pipeline runs (see sh._pipeline)
+        self._u8 = b''       # unfinished UTF-8 sequence held back by _text
+        self._cr = False     # the last byte send_bytes sent a session was a CR
+        self._ob = None      # bytearray send_bytes builds CRLF output for a telnet session in
+        self.follow = []     # [path, bytes sent, session, ticks_ms last looked] for each tail -f (see _follow)
+
+        self._poll = select.poll() # one poll object for stdin, the telnet listening socket and every client (see read_input)
+        self._poll.register(sys.stdin, select.POLLIN)
+        self._sm = select.POLLIN   # what stdin is armed for
+        self._lm = 0               # what server_socket is armed for
+        self._inpoll = False       # read_input is going through _poll's events (so _push mustn't start another ipoll)
+        self._wait = 1000          # ms read_input may block for when nothing is happening
+        self._kbd = select.poll()  # stdin only, for draining it
+        self._kbd.register(sys.stdin, select.POLLIN)
 
-        self._nbuf = ""
-        self._line = ""
-        self._cursor_pos = 0
-        self._lastread = time.ticks_ms()
-        self._esc_seq = ""
-        self._reading_esc = False
-        self._insert_mode = True  # Default to insert mode
-        self._hist_loc = -1  # Start with the most recent command (has 1 added before use; 0 means last)
-
-        # New global variables for terminal size and type
-        self._TERM_WIDTH = 80
-        self._TERM_HEIGHT = 24
-        self._TERM_TYPE = ""
-        self._TERM_TYPE_EX = ""
-    
         self.iac_cmds = [ # These need to be sent with specific timing to tell the client not to echo locally and exit line mode
             # First set of commands from the server
             b'\xff\xfd\x18'  # IAC DO TERMINAL TYPE
@@ -122,117 +342,188 @@ class CustomIO:
         #self.socket_buffers = {sock: "" for sock in self.sockets}
         sock[2] = {sock: "" for sock in self.sockets}
 
-    def _read_nonblocking(self):
-        if select.select([sys.stdin], [], [], 0)[0]:
-            self._nbuf += sys.stdin.read(1)
-            #self._nbuf += sys.stdin.read() # hangs
-
-            #print(f" got={self._nbuf} ") # cnd
+    # stdin is readable: take everything that is waiting (sys.stdin.read() with no size hangs)
+    def _read_stdin(self):
+        chars = sys.stdin.read(1)
+        while len(chars) < 64 and self._kbd.poll(0):
+            chars += sys.stdin.read(1)
+        return chars
 
-            i = self._nbuf.find('\n') + 1
-            if i < 1: i = None
-            ret = self._nbuf[:i]
-            self._nbuf = self._nbuf[len(ret):]
-            return ret
-        return None
+    # Arm obj for mask events in self._poll (after a one-shot event has fired, cur is 0). Returns what it is now armed for
+    def _arm(self, obj, mask, cur):
+        if cur != mask:
+            self._poll.modify(obj, mask)
+        return mask
 
 
     def ins_command(self,command,mv=True):
         # Replace this with the actual command execution logic
-        if self._cursor_pos>0:
-            print(f'\033[{self._cursor_pos}D', end='')  # Move cursor left by current cursor_pos
+        s = self.cur
+        if s.cursor_pos>0:
+            print(f'\033[{s.cursor_pos}D', end='')  # Move cursor left by current cursor_pos
         print(f'{command}\033[K', end='')  # output the new line, and clear anything after it
         if mv:
-            self._cursor_pos=len(command)
+            s.cursor_pos=len(command)
         else:
-            m=len(command)-self._cursor_pos
+            m=len(command)-s.cursor_pos
             if m>0:
                 print(f'\033[{m}D', end='')  # Move cursor back to same place it was
-        self._line=command
+        s.line=command
+
+    # Number of lines in history_file. Whenever the sizes of it and history_idx aren't what they were last time (first call, or one was deleted, cut or added to by
+    # something else), checks that they agree (last offset + last line == file size), rebuilding history_idx if not; every session's search then starts over
+    def _hist_len(self):
+        hsize, isize = self._tsize(self.history_file), self._tsize(self.history_idx)
+        if self._hist_n is None or hsize != self._hist_sz or isize != 4 * self._hist_n:
+            import struct
+            n = -1
+            try:
+                if isize % 4 == 0:
+                    n = isize // 4
+                    if n:
+                        with open(self.history_idx, 'rb') as f:
+                            f.seek(isize - 4)
+                            last = struct.unpack('<I', f.read(4))[0]
+                        with open(self.history_file, 'rb') as f:
+                            f.seek(last)
+                            line = f.readline()
+                        if last + len(line) != hsize or not line.endswith(b'\n'):
+                            n = -1
+                    elif hsize:
+                        n = -1
+            except OSError:
+                n = -1
+            if n < 0: # rebuild it (empty if history_file has gone)
+                n = 0
+                o = 0
+                try:
+                    with open(self.history_idx, 'wb') as idx:
+                        try:
+                            f = open(self.history_file, 'rb')
+                        except OSError:
+                            f = ()
+                        for line in f:
+                            idx.write(struct.pack('<I', o))
+                            o += len(line)
+                            n += 1
+                        if f:
+                            f.close()
+                except OSError:
+                    pass
+            self._hist_n = n
+            self._hist_sz = hsize
+            for s in [self.con] + self.sockets:
+                s.hs = None
+        return self._hist_n
 
-    def get_history_line(self,n):
-        with open(self.history_file, "r") as f:
-            for i, line in enumerate(f):
-                if i == n - 1:
-                    return line.split('\t', 1)[1].strip()
-        return None
+    def _tsize(self, file): # size of file, 0 if it is missing
+        try:
+            return os.stat(file)[6]
+        except OSError:
+            return 0
+
+    # Raw history_file lines first..last-1 (0-based), read with one index read and one history read. Fewer (maybe none) if the files don't have them after all
+    def _hist_lines(self, first, last):
+        import struct
+        n = min(last + 1, self._hist_n) - first # one extra offset tells us where the last wanted line ends
+        if n <= 0:
+            return []
+        with open(self.history_idx, 'rb') as f:
+            f.seek(4 * first)
+            data = f.read(4 * n)
+        if len(data) < 4 * n:
+            self._hist_n = None # re-check the index next time
+            return []
+        offs = struct.unpack(f'<{n}I', data)
+        with open(self.history_file, 'rb') as f:
+            f.seek(offs[0])
+            buf = f.read(offs[-1] - offs[0]) if last < self._hist_n else f.read()
+        return buf.split(b'\n')[:-1]
+
+    def get_history_line(self,n): # '' if there is no line n
+        if 0 < n <= self._hist_len():
+            try:
+                return self._hist_lines(n - 1, n)[0].decode('utf-8').split('\t', 1)[1].strip()
+            except (OSError, IndexError, UnicodeError):
+                pass
+        return ''
     
 
+    # hist_loc 0 is the most recent distinct line starting with pfx, 1 the one before that, etc. Repeated calls with the same pfx carry on from where the last scan stopped
+    # ('' if there is none)
     def search_history(self, pfx, hist_loc):
-        with open(self.history_file, "rb") as f:
-            f.seek(0, 2)  # Seek to the end of the file
-            file_size = f.tell()
-            remaining = file_size
-            buffer_size = 64
-            partial_line = b""
-            #matches = []
-            match=-1
-            prevm=''
-            match_idx = file_size - hist_loc * buffer_size
-
-            while remaining > 0 or partial_line:
-                read_size = min(buffer_size, remaining)
-                f.seek(remaining - read_size)
-                buffer = f.read(read_size)
-                remaining -= read_size
-
-                lines = buffer.split(b'\n')
-                if partial_line:
-                    lines[-1] += partial_line
-                partial_line = lines[0] if remaining > 0 else b""
-
-                for line in reversed(lines[1:] if remaining > 0 else lines):
-                    try:
-                        if line.strip():
-                            decoded_line = line.decode('utf-8').split('\t', 1)[1].strip()
-                            #print(f"considering line: {decoded_line}")
-                            if decoded_line.startswith(pfx):
-                                if decoded_line != prevm: # ignore duplicates
-                                    match += 1
-                                prevm=decoded_line
-                                #matches.append(decoded_line)
-                                #print(f"yes match={match} want={hist_loc} pfx='{pfx}'")
-                                if match==hist_loc:
-                                    return decoded_line
-                            #else:
-                            #   #print(f"no match={match} want={hist_loc} pfx='{pfx}'")
-                    except IndexError as e:
-                        print(self.shell.get_desc(60).format(e,line)) # f"possible history_file error: {e} for line: {line}")
-
-                #if len(matches) > hist_loc:
-                #    return matches[hist_loc]
-
-        return None
+        try:
+            return self._search_hist(pfx, hist_loc)
+        except (OSError, IndexError, UnicodeError): # history files gone or changed under us
+            self._hist_n = None
+            self.cur.hs = None
+            return ''
+
+    def _search_hist(self, pfx, hist_loc):
+        n = self._hist_len() # (a changed history file resets hs)
+        hs = self.cur.hs
+        if hs is None or hs[0] != pfx:
+            hs = self.cur.hs = [pfx, [], n, None]
+        matches = hs[1]
+        while len(matches) <= hist_loc and hs[2] > 0:
+            first = max(0, hs[2] - 16) # 16 lines per read, newest first
+            lines = self._hist_lines(first, hs[2])
+            for i in range(len(lines) - 1, -1, -1):
+                line = lines[i]
+                try:
+                    if line.strip():
+                        decoded_line = line.decode('utf-8').split('\t', 1)[1].strip()
+                        if decoded_line.startswith(pfx):
+                            if decoded_line != hs[3]: # ignore duplicates
+                                matches.append(first + i)
+                                hs[3] = decoded_line
+                                if len(matches) > hist_loc:
+                                    hs[2] = first + i
+                                    break
+                except IndexError as e:
+                    print(self.shell.get_desc(60).format(e,line)) # f"possible history_file error: {e} for line: {line}")
+            else:
+                hs[2] = first
+        if hist_loc < len(matches):
+            return self._hist_lines(matches[hist_loc], matches[hist_loc] + 1)[0].decode('utf-8').split('\t', 1)[1].strip()
+        return ''
 
 
     def _process_input(self, char):
-        self._lastread = time.ticks_ms()
+        s = self.cur
+        s.lastread = time.ticks_ms()
         
-        if self._reading_esc:
-            self._esc_seq += char
-            if self._esc_seq[-1] in 'ABCDEFGH~Rnc': 
-                response = self._handle_esc_sequence(self._esc_seq[2:])
-                self._reading_esc = False
-                self._esc_seq = ""
+        if s.reading_esc:
+            s.esc_seq += char
+            if s.esc_seq[-1] in 'ABCDEFGH~Rnc': 
+                response = self._handle_esc_sequence(s.esc_seq[2:])
+                s.reading_esc = False
+                s.esc_seq = ""
                 if response:
                     return response
-            elif time.ticks_ms() - self._lastread > 100:
-                self._reading_esc = False
-                self._esc_seq = ""
-                return self._line, "esc", self._cursor_pos
+            elif time.ticks_ms() - s.lastread > 100:
+                s.reading_esc = False
+                s.esc_seq = ""
+                return s.line, "esc", s.cursor_pos
         elif char == '\x1b':  # ESC sequence
-            self._reading_esc = True
-            self._esc_seq = char
+            s.reading_esc = True
+            s.esc_seq = char
         elif char == '\x03':  # ctrl-C ^C
+            if s.sock: # a telnet session only abandons its own line; it can't stop the shell everyone else is using
+                print('^C')
+                s.line = ""
+                s.cursor_pos = 0
+                s.hist_loc = -1
+                return '', 'enter', 0
             print(self.shell.get_desc(61)) # "KeyboardInterrupt:")
             raise KeyboardInterrupt
         elif char in ['\x7f', '\b']:  # Backspace
-            if self._cursor_pos > 0:
-                self._line = self._line[:self._cursor_pos - 1] + self._line[self._cursor_pos:]
-                self._cursor_pos -= 1
-                print('\b \b' + self._line[self._cursor_pos:] + ' ' + '\b' * (len(self._line) - self._cursor_pos + 1), end='')
+            if s.cursor_pos > 0:
+                s.line = s.line[:s.cursor_pos - 1] + s.line[s.cursor_pos:]
+                s.cursor_pos -= 1
+                print('\b \b' + s.line[s.cursor_pos:] + ' ' + '\b' * (len(s.line) - s.cursor_pos + 1), end='')
         elif char in ['\r', '\n']:  # Enter
-            ret_line = self._line
+            ret_line = s.line
             if ret_line.startswith("!"): # put history into buffer
                 if ret_line[1:].isdigit():
                     nth = int(ret_line[1:])
@@ -252,16 +543,16 @@ class CustomIO:
                         return '' # re-show the prompt
             else:
                 print('\r')
-                self._line = ""
-                self._cursor_pos = 0
-                self._hist_loc = -1
-                return ret_line, 'enter', self._cursor_pos
+                s.line = ""
+                s.cursor_pos = 0
+                s.hist_loc = -1
+                return ret_line, 'enter', s.cursor_pos
 
         elif char == '\001':  # repl exit
             return 'exit', 'enter', 0
         elif char == '\t':  # Tab
-            #return self._line, 'tab', self._cursor_pos
-            current_input = self._line[:self._cursor_pos]
+            #return s.line, 'tab', s.cursor_pos
+            current_input = s.line[:s.cursor_pos]
             if any(char in current_input for char in [' ', '<', '>', '|']):
                 # Extract the word immediately at the cursor
                 last_space = current_input.rfind(' ') + 1
@@ -269,121 +560,135 @@ class CustomIO:
                 #    last_space = 0
                 #else:
                 #    last_space += 1
-                word = current_input[last_space:self._cursor_pos]
+                word = current_input[last_space:s.cursor_pos]
         
                 try:
-                    for entry in os.listdir():
+                    for entry in (os.listdir() if s is self._here else os.listdir(s.cwd)):
                         if entry.startswith(word):
-                            self.ins_command(self._line[:self._cursor_pos] + entry[len(word):] + self._line[self._cursor_pos:])
+                            self.ins_command(s.line[:s.cursor_pos] + entry[len(word):] + s.line[s.cursor_pos:])
                             break
                 except OSError as e:
                     print(self.shell.get_desc(65).format(e)) # f"Error listing directory: {e}")
 
             else:
-                from sh1 import _iter_cmds
-                for cmd in _iter_cmds():
+                for cmd in self.shell._cmds():
                     if cmd.startswith(current_input):
-                         self.ins_command(self._line[:self._cursor_pos] + cmd[len(current_input):] + ' ' + self._line[self._cursor_pos:])
+                         self.ins_command(s.line[:s.cursor_pos] + cmd[len(current_input):] + ' ' + s.line[s.cursor_pos:])
                          break
-                del sys.modules["sh1"]
 
+        elif len(s.line) >= 512:
+            pass # line full
         else:
-            if self._insert_mode:
-                self._line = self._line[:self._cursor_pos] + char + self._line[self._cursor_pos:]
+            if s.insert_mode:
+                s.line = s.line[:s.cursor_pos] + char + s.line[s.cursor_pos:]
                 print(f'\033[@{char}', end='')  # Print char and insert space at cursor position
             else:
-                self._line = self._line[:self._cursor_pos] + char + self._line[self._cursor_pos + 1:]
+                s.line = s.line[:s.cursor_pos] + char + s.line[s.cursor_pos + 1:]
                 print(char, end='')
-            self._cursor_pos += 1
+            s.cursor_pos += 1
         
         return None
 
     def _handle_esc_sequence(self, seq):
+        s = self.cur
 
         if seq in ['A', 'B']:  # Up or Down arrow
             i = 1 if seq == 'A' else -1
             
-            if seq == 'B' and self._hist_loc < 1:
+            if seq == 'B' and s.hist_loc < 1:
                 return
         
-            self._hist_loc += i
+            s.hist_loc += i
 
-            history_line = self.search_history(self._line[:self._cursor_pos], self._hist_loc)
+            history_line = self.search_history(s.line[:s.cursor_pos], s.hist_loc)
 
-            #print(f"arrow {seq} line {self._hist_loc} h={history_line}")
+            #print(f"arrow {seq} line {s.hist_loc} h={history_line}")
             
             if history_line:
                 self.ins_command(history_line,mv=False)
             else:
-                self._hist_loc -= i
+                s.hist_loc -= i
 
-            #return self._line, 'up' if seq == 'A' else 'down', self._cursor_pos
+            #return s.line, 'up' if seq == 'A' else 'down', s.cursor_pos
         elif seq == 'C':  # Right arrow
-            if self._cursor_pos < len(self._line):
-                self._cursor_pos += 1
+            if s.cursor_pos < len(s.line):
+                s.cursor_pos += 1
                 print('\033[C', end='')
         elif seq == 'D':  # Left arrow
-            if self._cursor_pos > 0:
-                self._cursor_pos -= 1
+            if s.cursor_pos > 0:
+                s.cursor_pos -= 1
                 print('\033[D', end='')
         elif seq == '3~':  # Delete
-            if self._cursor_pos < len(self._line):
-                self._line = self._line[:self._cursor_pos] + self._line[self._cursor_pos + 1:]
+            if s.cursor_pos < len(s.line):
+                s.line = s.line[:s.cursor_pos] + s.line[s.cursor_pos + 1:]
                 print('\033[1P', end='')  # Delete character at cursor position
         elif seq == '2~':  # Insert
-            self._insert_mode = not self._insert_mode
+            s.insert_mode = not s.insert_mode
         elif seq in ['H', '1~']:  # Home
-            if self._cursor_pos > 0:
-                print(f'\033[{self._cursor_pos}D', end='')  # Move cursor left by current cursor_pos
-            self._cursor_pos = 0
+            if s.cursor_pos > 0:
+                print(f'\033[{s.cursor_pos}D', end='')  # Move cursor left by current cursor_pos
+            s.cursor_pos = 0
         elif seq in ['F', '4~']:  # End
-            d=len(self._line) - self._cursor_pos
+            d=len(s.line) - s.cursor_pos
             if d>0:
                 print(f'\033[{d}C', end='')  # Move cursor right by difference
-            self._cursor_pos = len(self._line)
+            s.cursor_pos = len(s.line)
         elif seq == '1;5D':  # Ctrl-Left
-            if self._cursor_pos > 0:
-                prev_pos = self._cursor_pos
-                while self._cursor_pos > 0 and self._line[self._cursor_pos - 1].isspace():
-                    self._cursor_pos -= 1
-                while self._cursor_pos > 0 and not self._line[self._cursor_pos - 1].isspace():
-                    self._cursor_pos -= 1
-                print(f'\033[{prev_pos - self._cursor_pos}D', end='')
+            if s.cursor_pos > 0:
+                prev_pos = s.cursor_pos
+                while s.cursor_pos > 0 and s.line[s.cursor_pos - 1].isspace():
+                    s.cursor_pos -= 1
+                while s.cursor_pos > 0 and not s.line[s.cursor_pos - 1].isspace():
+                    s.cursor_pos -= 1
+                print(f'\033[{prev_pos - s.cursor_pos}D', end='')
         elif seq == '1;5C':  # Ctrl-Right
-            if self._cursor_pos < len(self._line):
-                prev_pos = self._cursor_pos
-                while self._cursor_pos < len(self._line) and not self._line[self._cursor_pos].isspace():
-                    self._cursor_pos += 1
-                while self._cursor_pos < len(self._line) and self._line[self._cursor_pos].isspace():
-                    self._cursor_pos += 1
-                print(f'\033[{self._cursor_pos - prev_pos}C', end='')
+            if s.cursor_pos < len(s.line):
+                prev_pos = s.cursor_pos
+                while s.cursor_pos < len(s.line) and not s.line[s.cursor_pos].isspace():
+                    s.cursor_pos += 1
+                while s.cursor_pos < len(s.line) and s.line[s.cursor_pos].isspace():
+                    s.cursor_pos += 1
+                print(f'\033[{s.cursor_pos - prev_pos}C', end='')
         elif seq.endswith('R'):  # Cursor position report
             try:
-                self._TERM_HEIGHT, self._TERM_WIDTH = map(int, seq[:-1].split(';'))
+                s.h, s.w = map(int, seq[:-1].split(';'))
             except Exception as e:
                 print(self.shell.get_desc(64).format(seq[:-1],e,  binascii.hexlify(seq)  )) # "term-size set command {} error: {}; seq={}"
-                # when 2+ simultaneous terminals are connected, we get them all replying to us at the same time :-(
-            return self._line, 'sz', self._cursor_pos
+            return s.line, 'sz', s.cursor_pos
         elif seq.startswith('>') and seq.endswith('c'):  # Extended device Attributes
-            self._TERM_TYPE_EX = seq[1:-1]
-            return seq, 'attr', self._cursor_pos
+            s.term_ex = seq[1:-1]
+            return seq, 'attr', s.cursor_pos
         elif seq.startswith('?') and seq.endswith('c'):  # Device Attributes
-            self._TERM_TYPE = seq[1:-1]
-            return seq, 'attr', self._cursor_pos
+            s.term = seq[1:-1]
+            return seq, 'attr', s.cursor_pos
         return None
 
 
     def add_hist(self, line, retry=True):
         try:
-            with open(self.history_file, 'a') as hist_file:
-                hist_file.write(f"{int(time.time())}\t{line}\n")
+            n = self._hist_len()
+            try:
+                o = os.stat(self.history_file)[6]
+            except OSError:
+                o = 0
+            rec = f"{int(time.time())}\t{line}\n".encode('utf-8')
+            with open(self.history_file, 'ab') as hist_file:
+                hist_file.write(rec)
+            import struct
+            with open(self.history_idx, 'ab') as idx:
+                idx.write(struct.pack('<I', o))
+            self._hist_n = n + 1
+            self._hist_sz = o + len(rec)
+            for s in [self.con] + self.sockets: # the history is shared: every session's search starts over
+                s.hs = None
         except OSError:
+            self._hist_n = None # re-check the index next time
             # If an OSError is raised, the file system is read-only
             if retry:
                 try:
                     import storage
                     storage.remount("/", False)
-                    add_hist(self, line, False)
+                    self.add_hist(line, False)
                 except: 
                     pass
 
@@ -396,11 +701,27 @@ class CustomIO:
         raise EOFError(self.shell.get_desc(63)) # "No more input"
 
     def _del_old_socks(self,sockdel):
-        for i in sockdel:
-            client_socket=self.sockets[i]
-            client_socket['sock'].close()
-            print(self.shell.get_desc(62).format(i,client_socket['addr'])) # f"Closed telnet client {i} IP {client_socket['addr']}")
+        for i in sorted(set(sockdel), reverse=True): # backwards from the end, so index numbers don't change in the middle
+            s=self.sockets[i]
+            try:
+                self._poll.unregister(s.sock)
+            except:
+                pass
+            s.sock.close()
             del self.sockets[i]
+            if self.cur is s:
+                self.cur = self.con
+            if self.busy is s: # its command carries on at the console
+                self.busy = self.con
+            self._log(self.shell.get_desc(62).format(i,s.addr)) # f"Closed telnet client {i} IP {s.addr}")
+
+    # Server messages go to the console, whichever session is current
+    def _log(self, msg):
+        cur, pipe = self.cur, self.pipe
+        self.cur, self.pipe = self.con, None
+        print(msg)
+        self.cur = cur if cur is self.con or cur in self.sockets else self.con
+        self.pipe = pipe
 
     def setshell(self, shell):
         self.shell=shell
@@ -419,13 +740,16 @@ class CustomIO:
         self.server_socket.setblocking(False)
         self.server_socket.bind((ip_address, port))
         self.server_socket.listen(1)
+        self._poll.register(self.server_socket, select.POLLIN)
+        self._lm = select.POLLIN
 
         self.tspassword=self.shell._rw_toml('r', ['PASSWORD']) # ( defaults to "$5$bl0zjwUtt8T2WLJBH5Vadl/Ix6X+cFdJr5td4a0B+n0=$1txXuyLLzAvAMM/jYSlpRScy3nSwvTQ05Mv7At5LiSs=$", which is 'pass' )
         print(self.shell.get_desc(53).format(ip_address,port)) # "Telnet server started on IP", ip_address, "port", port)
 
 
 
-    # Read input from stdin, sockets, or files
+    # Read input from stdin, sockets, or files. Waits (up to self._wait ms) on the one poll object for whichever of stdin, the telnet clients and the listening socket is ready.
+    # Each session's keystrokes go through its own line editor; a finished line is returned with self.cur set to (and the cwd switched to) the session that typed it
     def read_input(self):
 
         # Read from input files
@@ -434,115 +758,183 @@ class CustomIO:
             if line:
                 return line
 
-        # Read from stdin
-        chars=1 # keep doing this 'till we get nothing more
-        while chars:
-            #print("r1")
-            chars = self._read_nonblocking()
-
-            # Read from sockets
-            sockdel=[]
-            for i, client_socket in enumerate(self.sockets):
-                client_socket['r'], _, client_socket['e'] = select.select([client_socket['sock']], [], [client_socket['sock']], 0)
-                for s in client_socket['r']:
-                    if 1:#try:
-                        data = client_socket['sock'].recv(1024).decode('utf-8').rstrip('\000')
-                        if data:
-                            if 'a' in client_socket: # not authenticated yet
-                                client_socket['a'] += data
-                                if ord(client_socket['a'][-1]) == 0x0d or len(client_socket['a'])>63: # caution; neither client_socket['a'][-1]=='\n' nor client_socket['a'].endswith('\n') work here!
-                                    client_socket['a'] = client_socket['a'][:-1] # .rstrip('\n') does not work here
-                                    import sh1
-                                    #if client_socket['a'] == self.tspassword:
-                                    if sh1._chkpass(self.shell,'chk',client_socket['a'],self.tspassword):
-                                        import network
-                                        del client_socket['a'] # this lets them in
-                                        #client_socket['sock'].send()
-                                        client_socket['buf']=self.shell.get_desc(59).format(network.WLAN(network.STA_IF).config('hostname'),os.uname().sysname,os.uname().version,os.uname().machine).encode('utf-8')  # \r\nWelcome to {} - {} Micropython {} on {}\r\n"
-                                        print("",end='')
-                                    else:
-                                        try:
-                                            client_socket['sock'].send(b'wrong.\r\n')
-                                        except:
-                                            pass
-                                        sockdel.insert(0,i) # kick off the attempt
-                                    del sys.modules['sh1'] 
-                            else:
-                                chars = chars + data if chars else data
-                        else:
-                            print("EOF ", client_socket['addr'])
-                            sockdel.insert(0,i) # remember to close it shortly (backwards from end, so index numbers don't change in the middle)
-                    #except Exception as e:
-                    #    print("read Exception ",e, "on ", client_socket['addr'])
-                    #    continue
-    
-                for s in client_socket['e']:
-                    print(self.shell.get_desc(58).format(client_socket['addr'])) # "Handling exceptional condition for", client_socket['addr'])
-                    if i not in sockdel:
-                        sockdel.insert(0,i) # remember to close it shortly (backwards from end, so index numbers don't change in the middle)
-    
-            self._del_old_socks(sockdel)
-    
-    
-            if self.server_socket:# Accept new connections
-                readable, _, exceptional = select.select([self.server_socket], [], [self.server_socket], 0)
-                for s in exceptional:
-                    print(self.shell.get_desc(57).format(s)) # "server_socket err?",s)
-                for s in readable:
-                    # Handle new connection
-                    client_sock, client_addr = self.server_socket.accept() # client_socket['sock'] is the socket, client_socket['addr'] is the address
-                    self.sockets.append({
-                        'sock': client_sock,
-                        'addr': client_addr, 
-                        'buf': b'', 
-                        'r': "", 
-                        'w': "", 
-                        'e': "",
-                        'a': "" # unauthenticated
-                    })
-        
-                    print(self.shell.get_desc(56).format(client_addr)) # "New telnet connection from", client_addr)
-                    client_sock.setblocking(False)
-        
-                    # Tell the new connection to set up their terminal for us
-                    for i, cmd in enumerate(self.iac_cmds + [b'Password: ']):
-                        #print("sent: ", binascii.hexlify(cmd))
-                        client_sock.send(cmd)
-                        # Wait for the client to respond
-                        time.sleep(0.1)
-                        if i>2:
-                            ready_to_read, _, _ = select.select([client_sock], [], [], 5)
-                            if ready_to_read:
-                                ignore = client_sock.recv(1024)
-                                #if ignore:
-                                #    print("got: ", binascii.hexlify(ignore))
+        for file in self.outfiles:
+            file.tick()
+
+        sockdel = []
+        wait = self._negotiate(sockdel)
+        if self.follow:
+            wait = 0 if self._follow() else min(wait, 500)
+        busy = self.busy
+        con = self.con
+
+        # (Re-)arm everything for the next wait: events are one-shot, clients with output waiting also want POLLOUT, and nobody is read while keystrokes they sent earlier are still queued (or while someone else's command runs)
+        self._sm = self._arm(sys.stdin, select.POLLIN if not con.inq and busy in (None, con) else 0, self._sm)
+        if con.inq and busy in (None, con):
+            wait = 0
+        if self.server_socket:
+            self._lm = self._arm(self.server_socket, select.POLLIN, self._lm)
+        for s in self.sockets:
+            if s.n is not None: # still negotiating: only its final reply is read
+                mask = select.POLLIN if s.n > len(self.iac_cmds) else 0
+            else:
+                mask = select.POLLOUT if s.buf.n else 0
+                if s.a is not None or busy in (None, s):
+                    if s.inq:
+                        wait = 0
+                    else:
+                        mask |= select.POLLIN
+            s.m = self._arm(s.sock, mask, s.m)
+
+        accept = False
+        self._inpoll = True
+        for obj, ev in self._poll.ipoll(wait, 1):
+            if obj is sys.stdin:
+                self._sm = 0
+                con.inq += self._read_stdin()
+                continue
+
+            if obj is self.server_socket:
+                self._lm = 0
+                if ev & (select.POLLERR | select.POLLHUP):
+                    self._log(self.shell.get_desc(57).format(obj)) # "server_socket err?",s)
+                else:
+                    accept = True # after this loop, so the poll object is not changed while we iterate it
+                continue
+
+            for i, s in enumerate(self.sockets):
+                if s.sock is obj:
+                    break
+            else:
+                continue
+            s.m = 0
+
+            if ev & (select.POLLERR | select.POLLHUP):
+                self._log(self.shell.get_desc(58).format(s.addr)) # "Handling exceptional condition for", s.addr)
+                sockdel.append(i) # remember to close it shortly
+                continue
+
+            if ev & select.POLLOUT:
+                try:
+                    s.buf.send(obj)
+                except Exception as e:
+                    self._log(self.shell.get_desc(4).format(e)) # Socket send exception: {}
+                    sockdel.append(i)
+                    continue
+
+            if ev & select.POLLIN:
+                if s.n is not None: # the client answered our terminal setup; discard that and go on to the password
+                    ignore = obj.recv(1024)
+                    #if ignore:
+                    #    print("got: ", binascii.hexlify(ignore))
+                    s.n = None
+                    continue
+                data = obj.recv(1024).decode('utf-8').rstrip('\000')
+                if data:
+                    if s.a is not None: # not authenticated yet
+                        s.a += data
+                        if ord(s.a[-1]) == 0x0d or len(s.a)>63: # caution; neither s.a[-1]=='\n' nor s.a.endswith('\n') work here!
+                            s.a = s.a[:-1] # .rstrip('\n') does not work here
+                            import sh1
+                            #if s.a == self.tspassword:
+                            if sh1._chkpass(self.shell,'chk',s.a,self.tspassword):
+                                import network
+                                s.a = None # this lets them in
+                                w = memoryview((self.shell.get_desc(59).format(network.WLAN(network.STA_IF).config('hostname'),os.uname().sysname,os.uname().version,os.uname().machine) + self.shell.prompt(s.cwd)).encode('utf-8'))  # terminal size query, then \r\nWelcome to {} - {} Micropython {} on {}\r\n"
+                                k = 0
+                                if not s.buf.n: # straight to the socket, so a small SH_SOCKBUF ring can't cut it short; the ring only gets what the socket didn't take
+                                    try:
+                                        k = obj.send(w) or 0
+                                    except OSError:
+                                        pass
+                                if s.buf.put(w[k:]) < len(w) - k:
+                                    self._log(self.shell.get_desc(4).format('welcome truncated')) # Socket send exception: {}
                             else:
-                                print(self.shell.get_desc(55).format(client_addr)) # f"No response from client {client_addr} within timeout. Disconnected")
-                                client_sock.close()
-                                del self.sockets[-1]
-
-            if chars:
-
-                for char in chars:
-                    response = self._process_input(char)
-                    if response:
-                        user_input, key, cursor = response
-                        if key=='enter':
-                            if len(user_input):
-                                self.add_hist(user_input)
-                            return user_input
-                        elif key != 'sz': 
-                            oops=self.shell.get_desc(54).format(key) # f" (mode {key} not implimented)";
-                            print(oops +  '\b' * (len(oops)), end='')
-
-            elif time.ticks_ms()-self._lastread > 100:
-                time.sleep(0.1)  # Small delay to prevent high CPU usage
+                                try:
+                                    obj.send(b'wrong.\r\n')
+                                except:
+                                    pass
+                                sockdel.append(i) # kick off the attempt
+                            self.shell._unload('sh1')
+                    else:
+                        s.inq += data
+                else:
+                    self._log("EOF {}".format(s.addr))
+                    sockdel.append(i) # remember to close it shortly
+        self._inpoll = False
+
+        self._del_old_socks(sockdel)
+        if accept:
+            self._accept()
+
+        for s in [con] + self.sockets:
+            if not s.inq or busy not in (None, s) or s.a is not None:
+                continue
+            self.cur = s # echo goes back to whoever is typing
+            chars, s.inq = s.inq, ""
+            for i, char in enumerate(chars):
+                response = self._process_input(char)
+                if response:
+                    user_input, key, cursor = response
+                    if key=='enter':
+                        s.inq = chars[i + 1:] # typed ahead; handled on the next call
+                        if len(user_input):
+                            self.add_hist(user_input)
+                        if self._here is not s: # commands run in the cwd of the session that typed them
+                            self._here.cwd = os.getcwd()
+                            os.chdir(s.cwd)
+                            self._here = s
+                        return user_input
+                    elif key != 'sz': 
+                        oops=self.shell.get_desc(54).format(key) # f" (mode {key} not implimented)";
+                        print(oops +  '\b' * (len(oops)), end='')
 
         return None
 
 
-    # Send characters to all sockets and files. should be called often with '' for flushing slow sockets (until it says all-gone)
+    # Handle a new telnet connection
+    def _accept(self):
+        client_sock, client_addr = self.server_socket.accept()
+        self.sockets.append(Session(client_sock, client_addr, int(self.shell.os_getenv('SH_SOCKBUF', 2048))))
+        self._log(self.shell.get_desc(56).format(client_addr)) # "New telnet connection from", client_addr)
+        client_sock.setblocking(False)
+        self._poll.register(client_sock, 0) # _negotiate() takes it from here
+
+
+    # Step every new connection through telnet setup without blocking anyone else: each of iac_cmds then the password prompt, 100ms apart, then up to 5s for the client's reply.
+    # Session.n is the next step and .t the ticks_ms it is due at. Returns how long read_input may wait before a step is due.
+    def _negotiate(self, sockdel):
+        wait = self._wait
+        for i, s in enumerate(self.sockets):
+            n = s.n
+            if n is None:
+                continue
+            due = time.ticks_diff(s.t, time.ticks_ms())
+            if due <= 0:
+                if n > len(self.iac_cmds):
+                    self._log(self.shell.get_desc(55).format(s.addr)) # f"No response from client {client_addr} within timeout. Disconnected")
+                    sockdel.append(i)
+                    continue
+                cmd = self.iac_cmds[n] if n < len(self.iac_cmds) else b'Password: '
+                #print("sent: ", binascii.hexlify(cmd))
+                try:
+                    s.sock.send(cmd)
+                except OSError:
+                    pass
+                s.n = n = n + 1
+                due = 100 if n <= len(self.iac_cmds) else 5000 # Wait for the client to respond
+                s.t = time.ticks_add(time.ticks_ms(), due)
+            if n <= len(self.iac_cmds):
+                wait = min(wait, due)
+        return wait
+
+
+    # Send characters to the current session (stdout for the console, else its socket) and all files. should be called often with '' for flushing slow sockets (until it says all-gone)
     def send_chars_to_all(self, chars):
+        if self.pipe: # a pipeline stage is printing: it's input for the next stage
+            self.pipe.write(chars)
+            return False
+        cur = self.cur
         if chars:
             chars = chars.replace('\r\n', '\n').replace('\n', '\r\n') # # Convert LF to CRLF (not breaking any existing ones)
             #if isinstance(chars, bytes):
@@ -554,51 +946,194 @@ class CustomIO:
 
 
             # Send to stdout
-            sys.stdout.write(chars)
+            if cur.sock is None:
+                sys.stdout.write(chars)
             # sys.stdout.flush() # AttributeError: 'FileIO' object has no attribute 'flush'
 
             # Send to all output files
-            for file in self.outfiles:
+            self._to_files(chars)
+        return self._push(memoryview(chars.encode('utf-8')) if chars and cur.sock else b'')
+
+
+    def _to_files(self, data):
+        for file in self.outfiles:
+            try:
+                file.write(data)
+            except Exception as e:
+                print(self.shell.get_desc(3).format(e)) #  File write exception: {}
+
+
+    # Raw bytes out (cat), with no str round trip: the console and > files take them as they are (the console's stdout makes LF CRLF itself), a telnet
+    # session gets LF made CRLF in a reused buffer, and a pipe stage gets text (see _text). data is bytes or a memoryview; None ends the stream
+    def send_bytes(self, data):
+        p = self.pipe
+        if isinstance(p, BlockWriter):
+            if data:
+                p.write(data)
+            return False
+        if p:
+            p.write(self._text(data))
+            return False
+        if data is None:
+            self._cr = False
+            return self._push(b'')
+        self._to_files(data)
+        cur = self.cur
+        if cur.sock is None:
+            sys.stdout.write(data)
+            return self._push(b'')
+        b = data if isinstance(data, bytes) else bytes(data) # to find() LFs in (MicroPython's bytearray and memoryview have no find)
+        mb = memoryview(b)
+        if self._ob is None or len(self._ob) < 2 * len(b):
+            self._ob = bytearray(2 * len(b))
+        ob = self._ob
+        m = 0
+        i = 0
+        j = b.find(b'\n')
+        while j >= 0:
+            if not (b[j - 1] == 13 if j else self._cr): # not already CRLF
+                ob[m:m + j - i] = mb[i:j]
+                m += j - i
+                ob[m] = 13
+                m += 1
+                i = j
+            j = b.find(b'\n', j + 1)
+        ob[m:m + len(b) - i] = mb[i:]
+        m += len(b) - i
+        if b:
+            self._cr = b[-1] == 13
+        return self._push(memoryview(ob)[:m])
+
+
+    # tail -f, from the idle loop: send each follower's session what has been added to its file since last time, up to 1K each per call (True if there is more).
+    # The size is looked at twice a second; a file that shrank is followed from its start. Followers of a session that has gone are dropped
+    def _follow(self):
+        if self.pipe is not None:
+            return False
+        more = False
+        now = time.ticks_ms()
+        for f in self.follow[:]:
+            s = f[2]
+            if s is not self.con and s not in self.sockets:
+                self.follow.remove(f)
+                continue
+            if time.ticks_diff(now, f[3]) < 500:
+                continue
+            try:
+                size = os.stat(f[0])[6]
+                if size < f[1]:
+                    f[1] = 0
+                data = b''
+                if size > f[1]:
+                    with open(f[0], 'rb') as fh:
+                        fh.seek(f[1])
+                        data = fh.read(min(size - f[1], 1024))
+            except OSError:
+                data = b''
+            if len(data) < 1024:
+                f[3] = now # caught up: look again in 500ms
+            else:
+                more = True
+            if data:
+                f[1] += len(data)
+                cur = self.cur
+                self.cur = s
                 try:
-                    file.write(chars)
-                    file.flush()
-                except Exception as e:
-                    print(self.shell.get_desc(3).format(e)) #  File write exception: {}
-
-        # Flag to check if any buffer has remaining data
-        any_buffer_non_empty = False
-
-        # Send to all sockets
-        sockdel=[]
-        for i, client_socket in enumerate(self.sockets):
-            if 'a' in client_socket:
-                continue # as-yet unauthenticated connection
-            client_socket['buf'] += chars.encode('utf-8')
-            if client_socket['buf']:
-                _, client_socket['w'], client_socket['e'] = select.select([], [client_socket['sock']], [client_socket['sock']], 0)
-                for s in client_socket['w']:
-                    try:
-                        bsent=client_socket['sock'].send(client_socket['buf'])
-                        client_socket['buf'] = client_socket['buf'][bsent:]  # Fix partial sends by updating the buffer
-                    except Exception as e:
-                        print(self.shell.get_desc(4).format(e)) # Socket send exception: {}
-                        sockdel.insert(0,i) # remember to close it shortly
+                    self.send_bytes(data)
+                    self.send_bytes(None)
+                finally:
+                    self.cur = cur
+        return more
 
-            if client_socket['buf']: # Update the flag if there is still data in the buffer
-                any_buffer_non_empty = True
 
-            if len(client_socket['buf']) > 80:
-                client_socket['buf'] = client_socket['buf'][-80:]  # Keep only the last 80 chars
+    # bytes -> str for a pipe stage: an unfinished UTF-8 sequence at the end is kept for the next call (None: the end, let it out). A chunk that isn't UTF-8 comes out a char per byte
+    def _text(self, data):
+        if data is None:
+            data, self._u8 = self._u8, b''
+            cut = len(data)
+        else:
+            if self._u8:
+                data = self._u8 + bytes(data)
+            cut = len(data)
+            i = cut - 1
+            while i >= 0 and i > cut - 4 and data[i] & 0xC0 == 0x80: # continuation bytes
+                i -= 1
+            if i >= 0 and data[i] >= 0xC0 and cut - i < (2 if data[i] < 0xE0 else 3 if data[i] < 0xF0 else 4):
+                cut = i
+            self._u8 = bytes(data[cut:])
+        try:
+            return str(data[:cut], 'utf-8')
+        except UnicodeError:
+            return ''.join(map(chr, data[:cut]))
+
+
+    # Send data (a memoryview) to the current session's socket: it goes into the session's ring, every client with output waiting is armed for POLLOUT,
+    # and the rings are drained from _poll's events (no wait while everything fits; up to 100ms at a time while cur's ring is full). True if any is still waiting
+    def _push(self, sdata):
+        cur = self.cur
+        off = cur.buf.put(sdata) if sdata else 0 # (sdata is empty unless cur is a telnet client)
+        sockdel = []
+        errs = []
+        stall = time.ticks_ms()
+        while True:
+            wait = False
+            for s in self.sockets:
+                if s.a is None and s.buf.n: # (not as-yet unauthenticated connections)
+                    s.m = self._arm(s.sock, s.m | select.POLLOUT, s.m)
+                    wait = True
+            if not wait:
+                break
+            # inside read_input's own event loop (a _log), the waiting output just goes out as far as the sockets take it
+            evs = [(s.sock, select.POLLOUT) for s in self.sockets if s.a is None and s.buf.n] if self._inpoll else self._poll.ipoll(0 if off >= len(sdata) else 100, 1)
+            for obj, ev in evs:
+                if obj is sys.stdin:
+                    self._sm = 0 # (one-shot: read_input re-arms it and sees it again)
+                    continue
+                if obj is self.server_socket:
+                    self._lm = 0
+                    continue
+                for i, s in enumerate(self.sockets):
+                    if s.sock is obj:
+                        break
+                else:
+                    continue
+                s.m = 0
+                if ev & select.POLLOUT and i not in sockdel:
+                    try:
+                        if s.buf.send(obj) and s is cur:
+                            stall = time.ticks_ms()
+                    except Exception as e:
+                        errs.append(e) # printed once this socket is gone (print comes back here)
+                        sockdel.append(i) # remember to close it shortly
+            if off < len(sdata):
+                off += cur.buf.put(sdata[off:])
+            if off >= len(sdata) or cur.sock is None or self.sockets.index(cur) in sockdel:
+                break # the rest can go out later
+            if time.ticks_diff(time.ticks_ms(), stall) > 10000: # ring full and nothing sent for 10s: give up on this client
+                errs.append('timeout')
+                sockdel.append(self.sockets.index(cur))
+                break
 
         self._del_old_socks(sockdel)
+        for e in errs:
+            self._log(self.shell.get_desc(4).format(e)) # Socket send exception: {}
 
-        return any_buffer_non_empty
+        return any(s.buf.n for s in self.sockets if s.a is None)
 
 
+    # BlockWriter for filepath; mode 'w' or 'a'. Its block size is the filesystem's (up to SH_WRBUF bytes)
+    def _writer(self, filepath, mode='w'):
+        bsize = int(self.shell.os_getenv('SH_WRBUF', 4096)) if self.shell else 4096
+        try:
+            bsize = min(bsize, os.statvfs(filepath.rsplit('/', 1)[0] or '/')[0] or bsize)
+        except OSError:
+            pass
+        return BlockWriter(filepath, mode, bsize)
+
     # Method to open an output file
-    def open_output_file(self, filepath):
+    def open_output_file(self, filepath, mode='w'):
         try:
-            file = open(filepath, 'w')
+            file = self._writer(filepath, mode)
             self.outfiles.append(file)
             #print("Output file opened successfully.")
         except Exception as e:
@@ -643,6 +1178,8 @@ class CustomIO:
     def flush(self):
         while self.send_chars_to_all(""):
             pass # time.sleep(0.1)  # Prevent a tight loop
+        for file in self.outfiles:
+            file.flush()
 
     def time_set(self,ts,subsec=0):
         tm = time.gmtime(ts)
@@ -722,8 +1259,22 @@ class IORedirector:
 class sh:
     def __init__(self,cio=None):
         self.settings_file = "/settings.toml"
+        self.desc_file = "/lib/sh.txt"
+        self.cmds_file = "/lib/sh_cmds.txt"  # command->module manifest, see tools/mkcmds.py
         self.cio=cio
         self._cache = {}
+        self._tcache = {}   # {settings file (# or $ first: with #includes): [((size, mtime) of it, its journal, its #includes...), {key: raw value}, [#included files]]} see _toml_idx
+        self._tpl = {}      # {string: compiled template} see subst_env
+        self._rnd = {}      # {string: rendered string} for subst_env(cache=True), emptied when settings change
+        self._didx = None   # sh.txt offset index (see _desc_idx)
+        self._dsig = None   # (size, mtime) of sh.txt when _didx was built
+        self._dchk = 0      # ticks_ms of the last sh.txt stat
+        self._dlru = []     # [[key, decoded string], ...] most recently used first
+        self._cmods = None  # [[module, ' cmd1 cmd2 ... '], ...] from cmds_file
+        self._mods = []     # command modules left loaded by _unload(), most recently used first
+        self._pcache = []   # [[command line, parsed], ...] see parse_command_line
+        self._rc = 0        # status of the last command: 0 ok (see _run1)
+        self._hold = 0      # >0 while a script runs: _unload() keeps modules loaded down to a quarter of SH_KEEP_FREE
         #self.get_desc=cio.get_desc
         #self.subst_env=cio.subst_env
         pass # self.history_file = "/history.txt"
@@ -768,18 +1319,81 @@ class sh:
         return line.strip()
 
 
-    def _rw_toml(self, op, key, value=None, file=None, default=None, subst=False, include=False): # key is [list] (1 elem for set)
+    # Parsed settings index: {key: raw value} for the whole file (with include: its #include files merged in, first one wins), re-parsed only
+    # if the size/mtime of the file, its journal or any file it included changes (stat'ed on every lookup) or after _rw_toml('w')
+    def _toml_idx(self, file, include=False, subst=False):
+        ck = ('$' if subst else '#') + file if include else file # include paths may differ with subst
+        c = self._tcache.get(ck)
+        try:
+            st = os.stat(file)
+        except OSError:
+            self._tcache.pop(ck, None)
+            open(file, 'w').close() # create empty one if missing
+            return {}
+        sig = ((st[6], st[8]),) + self._tsig([self._jnl(file)] + (c[2] if c else []))
+        if c and c[0] == sig:
+            return c[1]
+        incs = [file] if include else False # _rw_toml adds the files it includes
+        retd = self._rw_toml('i', [], file=file, include=incs, subst=subst)
+        if incs:
+            sig = sig[:2] + self._tsig(incs[1:])
+        if sig[1][0]: # journaled changes win over the file
+            for k, v in self._jread(file).items():
+                v = self._tdec(v)
+                if v == '':
+                    retd.pop(k, None)
+                else:
+                    retd[k] = v
+        self._tcache[ck] = [sig, retd, incs[1:] if incs else []]
+        if file == self.settings_file: # settings changed: drop cached values, rendered strings and parsed lines (aliases)
+            self._cache = {}
+            self._rnd = {}
+            self._pcache = []
+        return retd
+
+
+    def _tsig(self, files): # ((size, mtime), ...) of files, (0, 0) for a missing one
+        ret = []
+        for f in files:
+            try:
+                st = os.stat(f)
+                ret.append((st[6], st[8]))
+            except OSError:
+                ret.append((0, 0))
+        return tuple(ret)
+
+
+    def _rw_toml(self, op, key, value=None, file=None, default=None, subst=False, include=False): # key is [list] (1 elem for set). op 'r' reads, 'w' writes, 'i' returns the raw {key: value} index
+        if op == 'w' and not isinstance(key, dict): # one key: a transaction of one (see _tx_toml)
+            return self._tx_toml({key[0]: value}, file)
         retd={}
         order=list(key)
         if file is None:
             file = self.settings_file
 
+        if op == 'r':
+            idx = self._toml_idx(file, include, subst)
+            ret = []
+            for k in order:
+                v = idx.get(k)
+                if v is None:
+                    ret.append(default)
+                    continue
+                if subst:
+                    v = self.subst_env(v, default=None)
+                if v[:1] in ('[', '{', '('):
+                    import json
+                    v = json.loads(v)
+                ret.append(v)
+            return ret if len(order) > 1 else ret[0] if ret else default
+
         try:
             infile = [ open(file, 'r') ]
         except OSError:
-                #if op == 'w':
                 open(file, 'w').close() # create empty one if missing
-                return default
+                if op != 'w':
+                    return default
+                infile = [ open(file, 'r') ]
 
         outfile = None
         if op == "w":
@@ -817,6 +1431,8 @@ class sh:
                     infile.append( open(ifile, 'r') )
                 except Exception as e:
                     raise Exception(f"#include {ifile}: {e}")
+                if isinstance(include, list): # _toml_idx stat-checks these
+                    include.append(ifile)
 
             iline=self._strip_cmt(iline)
             sline += iline # aggressively remove comments too
@@ -833,34 +1449,18 @@ class sh:
 
             if len(kv) > 1 or extra_iteration == 1: # extra_iteration means "write if not found"
                 kvs=kv[0].strip()
-                if kvs in key or extra_iteration == 1:
+                if op == 'i' or kvs in key or extra_iteration == 1:
 
                     if op != 'w':
                         #if not len(kv) > 1: return None # cannot happen if op != 'w'
-                        key.remove(kvs)
-                        ret= ''.join(chr(int(part[:2], 16)) + part[2:] if i > 0 else part for i, part in enumerate(self._extr(kv[1]).split("\\x"))) # expand escape chars etc
-                        if subst:
-                            ret=self.subst_env(ret, default=None)
-                        if ret[0] in '[{(':
-                            import json
-                            ret=json.loads(ret)
-                        retd[kvs]=ret
-                        if not key: # got it/them all
-                            break
+                        if kvs not in retd: # first one wins
+                            retd[kvs]= self._tdec(kv[1])
 
-
-                    elif value == '':
-                        line='' # Delete the variable
-                        continue
-                    elif key is not None and len(key)>0:
-                        if isinstance(value,(dict, list, tuple)):
-                            import json
-                            line = '{} = {}\n'.format(key[0], json.dumps(value))
-                        elif value[0] in '+-.0123456789"\'': # Update the variable
-                            line = f'{key[0]} = {value}\n'
-                        else:
-                            line = '{} = "{}"\n'.format(key[0], value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\t", "\\t")) 
-                        key=[]
+                    elif extra_iteration == 1: # add the ones that were not found
+                        line = ''.join(f'{k} = {v}\n' for k, v in key.items() if v is not None)
+                    else: # key is {key: raw value or None to delete}, see _tx_toml
+                        v = key.pop(kvs)
+                        line = '' if v is None else f'{kvs} = {v}\n'
 
 
             if outfile:
@@ -872,23 +1472,85 @@ class sh:
 
         infile[-1].close()
         if op != 'w':
-            ret=[]
-            for key in order:
-                ret.append(retd.get(key, default))
-            if len(order)>1:
-                return ret
-            else:
-                return ret[0]
+            return retd
                 
         if outfile:
             outfile.close()
             old = file.rsplit('.', 1)[0] + "_old." + file.rsplit('.', 1)[1] # /settings_old.toml
-            import sh0  # load mv command
             # Replace old settings with the new settings
-            sh0.mv(self, {'sw': {}, 'args': ['mv', file, old]})
-            sh0.mv(self, {'sw': {}, 'args': ['mv', tmp, file]})
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+            os.rename(file, old)
+            os.rename(tmp, file)
+            self._tcache = {} # also any index that #included this file
+            self._cache = {}
 
     
+    # Apply {key: value} changes (value '' deletes) to a settings file with one rewrite. With SH_JOURNAL set, changes are appended to
+    # /settings_jnl.toml instead (read on top of the file) until it would pass SH_JOURNAL bytes; then it is folded in with the same single rewrite.
+    def _tx_toml(self, changes, file=None):
+        if file is None:
+            file = self.settings_file
+        chg = {}
+        for k, v in changes.items():
+            chg[k] = self._traw(v)
+        jf = self._jnl(file)
+        try:
+            js = os.stat(jf)[6]
+        except OSError:
+            js = 0
+        lim = int(self.os_getenv('SH_JOURNAL', 0))
+        if lim:
+            add = ''.join('{} = {}\n'.format(k, '""' if v is None else v) for k, v in chg.items())
+            if js + len(add) <= lim:
+                with open(jf, 'a') as f:
+                    f.write(add)
+                self._tcache = {}
+                self._cache = {}
+                return
+        if js:
+            j = self._jread(file)
+            for k, v in j.items():
+                if self._tdec(v) == '':
+                    j[k] = None
+            j.update(chg)
+            chg = j
+        self._rw_toml('w', chg, file=file)
+        if js:
+            os.remove(jf) # after the rewrite: if we stop in between, the journal just gets applied twice
+
+
+    def _jnl(self, file): # /settings.toml -> /settings_jnl.toml
+        return file.rsplit('.', 1)[0] + "_jnl." + file.rsplit('.', 1)[1]
+
+
+    def _jread(self, file): # {key: raw value} from the journal of file; the last change of a key wins
+        ret = {}
+        with open(self._jnl(file), 'r') as f:
+            for line in f:
+                kv = line.split('=', 1)
+                if len(kv) > 1:
+                    ret[kv[0].strip()] = kv[1].strip()
+        return ret
+
+
+    def _traw(self, value): # value as written in the file: numbers and quoted strings as given, other strings quoted, None to delete
+        if not isinstance(value, str): # numbers, dict, list
+            import json
+            return json.dumps(value)
+        if value == '':
+            return None
+        if value[0] in '+-.0123456789"\'':
+            return value
+        return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\t", "\\t"))
+
+
+    def _tdec(self, raw): # raw value -> string: strip quotes or comments, expand \x escapes
+        return ''.join(chr(int(part[:2], 16)) + part[2:] if i > 0 else part for i, part in enumerate(self._extr(raw).split("\\x")))
+
+
     # Print output to the screen, or a file
     def fprint(shell,line=None,fn=None,end=b'\n'):
         if line is None:
@@ -918,66 +1580,251 @@ class sh:
         return ret
 
 
-    def subst_env(shell, value, default=None, cache=False):
-        result = ''
+    # Compile a string once into literal segments and (name, unset text, indirect) variable references
+    def _tcomp(shell, value):
+        t = []
+        lit = ''
         i = 0
-        while i < len(value):
-            if value[i] == '\\' and i + 1 < len(value) and value[i + 1] == '$':
-                result += '$'
-                i += 2
-            elif value[i] == '$':
-                i += 1
-                i, expanded = shell.exp_env(i,value,cache)
-                result += expanded
+        while True:
+            p = value.find('$', i)
+            if p < 0:
+                break
+            if p and value[p - 1] == '\\': # \$ is a literal $
+                lit += value[i:p - 1] + '$'
+                i = p + 1
+                continue
+            lit += value[i:p]
+            p += 1
+            if value[p:p + 1] == '{':
+                end = value.find('}', p)
+                if end < 0:
+                    lit += '$'
+                    i = p
+                    continue
+                name = value[p + 1:end]
+                end += 1
             else:
-                result += value[i]
-                i += 1
-        return result
+                end = p
+                while end < len(value) and (value[end].isalpha() or value[end].isdigit() or value[end] == '_'):
+                    end += 1
+                name = value[p:end]
+                if not name:
+                    lit += '$'
+                    i = p
+                    continue
+            if lit:
+                t.append(lit)
+                lit = ''
+            if name.startswith('!'):
+                t.append((name[1:], f'${{{name}}}', 1))
+            else:
+                t.append((name, value[p - 1:end], 0))
+            i = end
+        lit += value[i:]
+        if lit:
+            t.append(lit)
+        return t
+
+
+    def subst_env(shell, value, default=None, cache=False):
+        if '$' not in value:
+            return value
+        if cache:
+            shell._toml_idx(shell.settings_file) # notices an edited settings file
+            r = shell._rnd.get(value)
+            if r is not None:
+                return r
+        t = shell._tpl.get(value)
+        if t is None:
+            t = shell._tcomp(value)
+            if len(shell._tpl) > 24:
+                shell._tpl = {}
+            shell._tpl[value] = t
+        r = ''.join(x if isinstance(x, str) else shell._tvar(x, cache) for x in t)
+        if cache:
+            shell._rnd[value] = r
+        return r
+
+
+    def _tvar(shell, v, cache):
+        if v[2]: # ${!name}: the value of name is the variable to expand
+            name = shell.os_getenv(v[0], v[1], cache=cache)
+            return shell.os_getenv(name, f'${{{name}}}', cache=cache)
+        return shell.os_getenv(v[0], v[1], cache=cache)
+
+
+    # Build the offset index for sh.txt: one "\nkey\nkey\n" string plus an array of byte offsets (same order). Rebuilt if the file changes.
+    def _desc_idx(shell):
+        try:
+            st = os.stat(shell.desc_file)
+        except OSError:
+            st = (0,) * 10
+        if shell._didx is not None and shell._dsig == (st[6], st[8]):
+            return shell._didx
+        from array import array
+        names = ['']
+        offs = array('I')
+        o = 0
+        with open(shell.desc_file, 'rb') as file:
+            for line in file:
+                k = line.split(b'\t', 1)[0]
+                if len(k) < len(line):
+                    names.append(k.decode('utf-8'))
+                    offs.append(o)
+                o += len(line)
+        shell._didx = ('\n'.join(names) + '\n', offs)
+        shell._dsig = (st[6], st[8])
+        shell._dlru = []  # file changed: forget decoded strings
+        return shell._didx
 
 
     # For reading help and error messages etc out of a text file
     def get_desc(shell,keyword):
         #with open(__file__.rsplit('.', 1)[0] + '.txt', 'r') as file:   # /lib/sh.txt # sometimes (if pwd is /lib/) __file__ is sh.mpy without the /lib/
-        with open("/lib/sh.txt", 'r') as file:
-            for line in file:
-                try:
-                    key, description = line.split('\t', 1)
-                    if key == str(keyword):
-                        ret= ''.join(chr(int(part[:2], 16)) + part[2:] if i > 0 else part for i, part in enumerate(description.strip().split("\\x"))) # expand \x1b and \x0d etc
-                        return shell.subst_env(ret).replace("\\n","\n").replace("\\t", "\t").replace("\\\\", "\\")
-                except Exception as e: 
-                    return f'corrupt help file: {e}'
-        return f"(missing helptext '{keyword}')"
+        keyword = str(keyword)
+        try:
+            if shell._didx is None or time.ticks_diff(time.ticks_ms(), shell._dchk) > 2000: # re-stat sh.txt at most every 2s
+                shell._desc_idx()
+                shell._dchk = time.ticks_ms()
+            for i, kv in enumerate(shell._dlru): # small LRU of decoded strings, most recent first
+                if kv[0] == keyword:
+                    if i:
+                        shell._dlru.insert(0, shell._dlru.pop(i))
+                    ret = kv[1]
+                    break
+            else:
+                names, offs = shell._didx
+                p = names.find('\n' + keyword + '\n')
+                if p < 0:
+                    return f"(missing helptext '{keyword}')"
+                with open(shell.desc_file, 'rb') as file:
+                    file.seek(offs[names.count('\n', 0, p)])
+                    description = file.readline().decode('utf-8').split('\t', 1)[1]
+                ret= ''.join(chr(int(part[:2], 16)) + part[2:] if i > 0 else part for i, part in enumerate(description.strip().split("\\x"))) # expand \x1b and \x0d etc
+                shell._dlru.insert(0, [keyword, ret])
+                if len(shell._dlru) > 8:
+                    shell._dlru.pop()
+            return shell.subst_env(ret).replace("\\n","\n").replace("\\t", "\t").replace("\\\\", "\\")
+        except Exception as e: 
+            return f'corrupt help file: {e}'
+
+
+    # Size of the command module file we would import (-1 if missing)
+    def _mod_size(shell, mod):
+        for ext in ('mpy', 'py'):
+            try:
+                return os.stat(f"{shell.cmds_file.rsplit('/', 1)[0]}/{mod}.{ext}")[6]
+            except OSError:
+                pass
+        return -1
+
+
+    # Load (once) and verify the command->module manifest. If it is missing, or a module's size no longer matches, rebuild it on the device
+    def _cmd_idx(shell, rebuild=False):
+        if shell._cmods is None or rebuild:
+            cmods = []
+            try:
+                with open(shell.cmds_file, 'r') as file:
+                    for line in file:
+                        mod, size, names = line.rstrip('\n').split('\t', 2)
+                        cmods.append([mod, f" {names} "])
+                        if shell._mod_size(mod) != int(size):
+                            rebuild = True
+            except (OSError, ValueError):
+                rebuild = True
+            if rebuild:
+                gc.collect()
+                import sh1
+                cmods = sh1._mk_cmds(shell, [m[0] for m in cmods] or ["sh0", "sh1", "sh2", "sh3", "sh4"])
+                shell._unload("sh1")
+            shell._cmods = cmods
+        return shell._cmods
+
+
+    # Which module holds this command (None if no module has it)
+    def _cmd_mod(shell, cmd, rebuild=False):
+        for mod, names in shell._cmd_idx(rebuild):
+            if f" {cmd} " in names:
+                return mod
+        return None
+
+
+    # Finished with a command module: keep it (and other recently used ones) loaded while gc.mem_free() stays above SH_KEEP_FREE, otherwise unload in least-recently-used order
+    def _unload(shell, mod=None, flush=False):
+        if mod in shell._mods:
+            shell._mods.remove(mod)
+        if mod in sys.modules:
+            shell._mods.insert(0, mod)
+        gc.collect()
+        keep = -1 if flush else int(shell.os_getenv('SH_KEEP_FREE', 65536)) // (4 if shell._hold else 1)
+        while shell._mods and (keep < 0 or gc.mem_free() < keep):
+            m = shell._mods.pop()
+            if m in sys.modules: del sys.modules[m]
+            gc.collect()
+
+
+    # All command names, without importing any command modules
+    def _cmds(shell):
+        for mod, names in shell._cmd_idx():
+            for name in names.split():
+                yield name
+
+
+    # Walk a directory tree without recursion: yields (path, type, size, mtime) for top and everything under it (type 0x4000 for a directory, else a file; mtime 0 unless stat).
+    # Only one os.ilistdir iterator per level is held, so memory is O(depth). maxdepth: levels below top to go into (-1: all); prune(entry): True to not go into
+    # that directory; post: a directory comes after what is in it (for rm -r and du). An entry is only stat'ed for stat, or if the port's ilistdir gives no size.
+    def _walk(shell, top, maxdepth=-1, prune=None, post=False, stat=False):
+        if len(top) > 1:
+            top = top.rstrip('/')
+        st = os.stat(top) # a missing top raises OSError for the caller to report
+        ent = (top, st[0] & 0x4000 or 0x8000, st[6], st[8] if stat else 0)
+        if ent[1] != 0x4000 or maxdepth == 0 or (prune and prune(ent)):
+            yield ent
+            return
+        if not post:
+            yield ent
+        stack = [(top.rstrip('/') + '/', os.ilistdir(top), ent)]
+        while stack:
+            pre, it, dent = stack[-1]
+            try:
+                e = next(it)
+            except StopIteration:
+                stack.pop()
+                if post:
+                    yield dent
+                continue
+            p = pre + e[0]
+            size = e[3] if len(e) > 3 else -1
+            t = 0
+            if stat or size < 0:
+                st = os.stat(p)
+                size = st[6]
+                t = st[8]
+            ent = (p, e[1] & 0x4000 or 0x8000, size, t)
+            if ent[1] == 0x4000 and (maxdepth < 0 or len(stack) < maxdepth) and not (prune and prune(ent)):
+                if not post:
+                    yield ent
+                stack.append((p + '/', os.ilistdir(p), ent))
+            else:
+                yield ent
+
+
+    # Line store for a pipe stage that needs all its input before it can output (see Spool)
+    def _spool(shell, key=None, reverse=False):
+        return Spool(int(shell.os_getenv('SH_PIPEBUF', 4096)), key, reverse)
 
 
     # error-message expander helpers
     def _ea(shell, cmdenv):
         print(shell.get_desc(9).format(cmdenv['args'][0])) # {}: missing operand(s)
+        shell._rc = 1
 
     def _ee(shell, cmdenv, e):
         print(shell.get_desc(10).format(cmdenv['args'][0],e)) # {}: {}
+        shell._rc = 1
 
 
 
-    def exp_env(shell, start, value, cache=False):
-        if value[start] == '{':
-            end = value.find('}', start)
-            var_name = value[start + 1:end]
-            if var_name.startswith('!'):
-                var_name = shell.os_getenv(var_name[1:], f'${{{var_name}}}', cache=cache)
-                var_value = shell.os_getenv(var_name, f'${{{var_name}}}', cache=cache)
-            else:
-                var_value = shell.os_getenv(var_name, f'${{{var_name}}}', cache=cache)
-            return end + 1, var_value
-        else:
-            end = start
-            while end < len(value) and (value[end].isalpha() or value[end].isdigit() or value[end] == '_'):
-                end += 1
-            var_name = value[start:end]
-            var_value = shell.os_getenv(var_name, f'${var_name}', cache=cache)
-            return end, var_value
-
-
     def parse_command_line(shell, command_line):
         def split_command_o(command_line):
             # """Split command line into parts respecting quotes and escape sequences."""
@@ -1018,68 +1865,70 @@ class sh:
         
         
         def split_command(command_line):
-            # """Split command line into parts respecting quotes and escape sequences."""
+            # """Split command line into parts respecting quotes and escape sequences. One pass; tokens are sliced out of command_line rather than built up a character at a time."""
             parts = []
-            part = ''
-            in_single_quote = False
-            in_double_quote = False
-            in_backticks = False
-            in_subshell = 0
-            escape = False
-        
+            part = []   # earlier pieces of the token being read (there is more than one only around a \ escape)
+            start = -1  # where the current piece began; -1 when no token is in progress
+            q = ''      # the open ' " or ` (everything up to its partner is literal)
+            depth = 0   # $( nesting
             i = 0
-            while i < len(command_line):
+            n = len(command_line)
+            while i < n:
                 char = command_line[i]
-                if escape:
-                    part += char
-                    escape = False
-                elif char == '\\':
-                    escape = True
-                elif char == '"' and not in_single_quote and not in_backticks and in_subshell == 0:
-                    in_double_quote = not in_double_quote
-                    part += char
-                elif char == "'" and not in_double_quote and not in_backticks and in_subshell == 0:
-                    in_single_quote = not in_single_quote
-                    part += char
-                elif char == '`' and not in_single_quote and not in_double_quote and in_subshell == 0:
-                    if in_backticks:
-                        in_backticks = False
-                        part += char
-                        parts.append(part)
-                        part = ''
-                    else:
-                        if part:
-                            parts.append(part)
-                            part = ''
-                        in_backticks = True
-                        part += char
-                elif char == '$' and i + 1 < len(command_line) and command_line[i + 1] == '(' and not in_single_quote and not in_double_quote and not in_backticks:
-                    if in_subshell == 0 and part:
-                        parts.append(part)
-                        part = ''
-                    in_subshell += 1
-                    part += char
-                elif char == ')' and not in_single_quote and not in_double_quote and not in_backticks and in_subshell > 0:
-                    in_subshell -= 1
-                    part += char
-                    if in_subshell == 0:
-                        parts.append(part)
-                        part = ''
-                elif char.isspace() and not in_single_quote and not in_double_quote and not in_backticks and in_subshell == 0:
-                    if part:
-                        parts.append(part)
-                        part = ''
-                elif char in '|<>' and not in_single_quote and not in_double_quote and not in_backticks and in_subshell == 0:
-                    if part:
-                        parts.append(part)
-                        part = ''
-                    parts.append(char)
-                else:
-                    part += char
+                if char == '\\':
+                    if start >= 0:
+                        part.append(command_line[start:i])
+                    start = i + 1 # the escaped character starts the next piece
+                    i += 2
+                    continue
+                if q:
+                    if char == q:
+                        q = ''
+                        if char == '`': # a backtick command is a token of its own
+                            parts.append(''.join(part) + command_line[start:i + 1])
+                            part = []
+                            start = -1
+                elif depth:
+                    if char == ')':
+                        depth -= 1
+                        if depth == 0:
+                            parts.append(''.join(part) + command_line[start:i + 1])
+                            part = []
+                            start = -1
+                    elif char == '$' and command_line[i + 1:i + 2] == '(':
+                        depth += 1
+                        i += 1
+                elif char in '"\'':
+                    q = char
+                    if start < 0:
+                        start = i
+                elif char.isspace() or char in '|<>`;' or (char == '$' and command_line[i + 1:i + 2] == '(') or (char == '&' and command_line[i + 1:i + 2] == '&'):
+                    if start >= 0: # end of a token
+                        t = ''.join(part) + command_line[start:i]
+                        if t:
+                            parts.append(t)
+                        part = []
+                        start = -1
+                    if char == '`':
+                        q = char
+                        start = i
+                    elif char == '$':
+                        depth = 1
+                        start = i
+                        i += 1
+                    elif char in '>|&' and command_line[i + 1:i + 2] == char: # >> || &&
+                        parts.append(char + char)
+                        i += 1
+                    elif not char.isspace():
+                        parts.append(char)
+                elif start < 0:
+                    start = i
                 i += 1
-        
-            if part:
-                parts.append(part)
+
+            if start >= 0:
+                t = ''.join(part) + command_line[start:]
+                if t:
+                    parts.append(t)
             return parts
         
 
@@ -1127,24 +1976,26 @@ class sh:
             # """Process parts into switches and arguments."""
             #sw = {}
             #arg = []
-            redirections = {'stdin': None, 'stdout': None, 'stderr': None}
-            current_cmd = {'line': '', 'sw': {}, 'args': [], 'redirections': redirections, 'pipe_from': None}
+            current_cmd = {'line': [], 'sw': {}, 'args': [], 'redirections': {'stdin': None, 'stdout': None, 'stderr': None}, 'pipe_from': None} # 'line' is joined up at the end
 
             cmds = [current_cmd]
             i = 0
             while i < len(parts):
                 part = parts[i]
                 if part == '|':
-                    current_cmd = {'line': '', 'sw': {}, 'args': [], 'redirections': {'stdin': None, 'stdout': None, 'stderr': None}, 'pipe_from': cmds[-1]}
+                    current_cmd = {'line': [], 'sw': {}, 'args': [], 'redirections': {'stdin': None, 'stdout': None, 'stderr': None}, 'pipe_from': cmds[-1]}
+                    cmds.append(current_cmd)
+                elif part in (';', '&&', '||'): # next pipeline of a command list; 'op' says whether it runs (see _run)
+                    current_cmd = {'line': [], 'sw': {}, 'args': [], 'redirections': {'stdin': None, 'stdout': None, 'stderr': None}, 'pipe_from': None, 'op': part}
                     cmds.append(current_cmd)
                 elif part == '>':
-                    redirections['stdout'] = parts[i + 1]
+                    current_cmd['redirections']['stdout'] = shell.subst_env(parts[i + 1]) if i + 1 < len(parts) else ''
                     i += 1
                 elif part == '>>':
-                    redirections['stdout'] = {'append': parts[i + 1]}
+                    current_cmd['redirections']['stdout'] = {'append': shell.subst_env(parts[i + 1]) if i + 1 < len(parts) else ''}
                     i += 1
                 elif part == '<':
-                    redirections['stdin'] = parts[i + 1]
+                    current_cmd['redirections']['stdin'] = shell.subst_env(parts[i + 1]) if i + 1 < len(parts) else ''
                     i += 1
                 elif part.startswith('--'):
                     if '=' in part:
@@ -1152,10 +2003,10 @@ class sh:
                         if not (value.startswith("'") and value.endswith("'")):
                             value = shell.subst_env(substitute_backticks(value))
                         current_cmd['sw'][key] = value
-                        current_cmd['line'] += f" --{key}={value}"
+                        current_cmd['line'].append(f"--{key}={value}")
                     else:
                         current_cmd['sw'][part[2:]] = True
-                        current_cmd['line'] += ' ' + part
+                        current_cmd['line'].append(part)
                 elif part.startswith('-') and len(part) > 1:
                     j = 1
                     while j < len(part):
@@ -1165,41 +2016,126 @@ class sh:
                         else:
                             current_cmd['sw'][part[j]] = part[j + 1:] if j + 1 < len(part) else True
                             break
-                    current_cmd['line'] += ' ' + part
+                    current_cmd['line'].append(part)
                 else:
                     if not (part.startswith("'") and part.endswith("'")):
                         part = shell.subst_env(substitute_backticks(part))
                     current_cmd['args'].append(part)
-                    current_cmd['line'] += (' ' if current_cmd['line'] else '') + part
+                    current_cmd['line'].append(part)
 
                 i += 1
 
+            for c in cmds:
+                c['line'] = ' '.join(c['line'])
             return cmds
 
-        parts = split_command(command_line)
+        # Lines without $ or ` expand the same every time, so their parse is remembered (small LRU, most recent first, keyed on the line as typed and emptied
+        # when settings change); callers get a copy they are free to change
+        cache = '$' not in command_line and '`' not in command_line
+        if cache:
+            shell._toml_idx(shell.settings_file) # notices a changed alias
+            for i, kv in enumerate(shell._pcache):
+                if kv[0] == command_line:
+                    if i:
+                        shell._pcache.insert(0, shell._pcache.pop(i))
+                    return shell._pcopy(kv[1])
+
+        # optional aliases: a command word (the first, or after | ; && ||) that is a settings key is replaced by its value. Expanded once, so ls = "ls -l" works
+        parts = []
+        cmd = True
+        for t in split_command(command_line):
+            alias = shell.os_getenv(t) if cmd else None
+            if alias is None:
+                parts.append(t)
+            else:
+                parts += split_command(alias)
+                if '$' in alias or '`' in alias:
+                    cache = False
+            cmd = t in ('|', ';', '&&', '||')
         cmds = process_parts(parts)
 
+        if cache:
+            shell._pcache.insert(0, [command_line, shell._pcopy(cmds)])
+            del shell._pcache[8:]
         return cmds
 
 
+    # Copy of a parse_command_line() result: fresh dicts and lists, so a command changing its cmdenv doesn't change the cached one
+    def _pcopy(shell, cmds):
+        out = []
+        for c in cmds:
+            d = dict(c)
+            d['sw'] = dict(c['sw'])
+            d['args'] = list(c['args'])
+            d['redirections'] = dict(c['redirections'])
+            if d['pipe_from'] is not None:
+                d['pipe_from'] = out[-1]
+            out.append(d)
+        return out
+
+
     
+    def prompt(shell, cwd=None):
+        return shell.subst_env("$GRN$HOSTNAME$NORM:{}\\$ ",cache=True).format(cwd or os.getcwd()) # the stuff in the middle is the prompt
+
+
     def execute_command(shell,command):
         # """Execute a command and return its output. Placeholder for actual execution logic."""
-        for _ in range(2): # optional alias expander
-            parts = shell.parse_command_line(command)
-            cmdenv = parts[0]  # Assuming simple commands for mock execution
-            cmd=cmdenv['args'][0]
-            #print("executing: {}".format(cmdenv['line'])) #DBG
-
-            alias = shell.os_getenv(cmd)
-            if alias is not None:
-                command=alias + command[command.find(' '):] if ' ' in command else alias
-            else:
-                break
+        return shell._run(shell.parse_command_line(command))
+
+
+    # Run a parsed command line: pipelines joined by ; && || (a stage with an 'op' starts the next one). && and || look at shell._rc, the status of the last one that ran
+    def _run(shell, parts):
+        if not shell._syntax(parts):
+            return 1
+        i = 0
+        while i < len(parts):
+            j = i + 1
+            while j < len(parts) and parts[j]['pipe_from'] is not None:
+                j += 1
+            op = parts[i].get('op')
+            if not parts[i]['args']:
+                break # trailing ; (or an empty line)
+            if not (op == '&&' and shell._rc or op == '||' and not shell._rc):
+                if not shell._run1(parts[i:j]):
+                    return 0 # exit
+            i = j
+        return 1
+
+
+    # The whole list is checked before any of it runs: a command missing before or after | ; && || (a trailing ; is fine), or < > >> with no file, refuses the line (status 2)
+    def _syntax(shell, parts):
+        for k, c in enumerate(parts):
+            tok = None
+            if not c['args']:
+                if k == len(parts) - 1 and (k == 0 or c.get('op') == ';'):
+                    continue
+                tok = c.get('op', '|') if k else parts[1].get('op', '|')
+            r = c['redirections']
+            for v in (r['stdin'], r['stdout']['append'] if isinstance(r['stdout'], dict) else r['stdout']):
+                if v == '' and not tok:
+                    tok = 'newline'
+            if tok:
+                print(shell.get_desc(86).format(tok)) # sh: syntax error near unexpected token `|'
+                shell._rc = 2
+                return False
+        return True
+
+
+    # Run one pipeline (or a simple command). Sets shell._rc: 0, or non-0 if the command printed an error (_ee/_ea), returned False or doesn't exist
+    def _run1(shell, parts):
+        shell._rc = 0
+        cmdenv = parts[0]  # Assuming simple commands for mock execution
+        cmd=cmdenv['args'][0]
+        #print("executing: {}".format(cmdenv['line'])) #DBG
 
         # internal commands
         if cmd == 'exit':
-            os.chdir("/") # Leaving without doign this makes most future imports break
+            if shell.cio and shell.cio.cur.sock: # a telnet session just hangs up
+                shell.cio._del_old_socks([shell.cio.sockets.index(shell.cio.cur)])
+                return 1
+            if not shell._hold: # (in a script, exit just ends the script)
+                os.chdir("/") # Leaving without doign this makes most future imports break
             return 0
 
         if cmd == '.':
@@ -1214,25 +2150,95 @@ class sh:
         #    return "file1.txt\nfile2.txt\nfile3.txt"
 
 
-        for mod in ["sh0", "sh1", "sh2", "sh3"]:
+        r = cmdenv['redirections']
+        if len(parts) > 1 or r['stdin'] is not None or r['stdout'] is not None:
+            return shell._pipeline(parts)
+
+        mod, command_function = shell._cmd_fn(cmd)
+        if command_function:
+            #print(f"running {mod}.{cmd}")
+            ret=command_function(shell,cmdenv)  # Run the command
+            if ret is False:
+                shell._rc = 1
+            shell._unload(mod)
+        return 1 # keep running
+
+
+    # (module name, function) for a command, importing its module. (None, None) if there is no such command
+    def _cmd_fn(shell, cmd):
+        for rebuild in (False, True): # the manifest says which one module to import; if it was wrong, rebuild it and look once more
+            mod = shell._cmd_mod(cmd, rebuild)
+            if mod is None:
+                break
             gc.collect()
             module = __import__(mod)
 
             # sh_module = sys.modules['sh0']
             command_function = getattr(module, cmd,None)
             if command_function:
-                #print(f"running {mod}.{cmd}")
-                ret=command_function(shell,cmdenv)  # Run the command
-                if mod in sys.modules: del sys.modules[mod]
-                gc.collect()
-                return 1
-                # return ret
-                break
+                return mod, command_function
             if mod in sys.modules: del sys.modules[mod]
             gc.collect()
 
         print(shell.get_desc(0).format(cmd)) # {} command not found
-        return 1 # keep running
+        shell._rc = 127
+        return None, None
+
+
+    # cmd1 | cmd2 | ... : later stages are set up first; a stage that reads stdin (its cmdenv['pipe_from'] is set) returns a generator, which is sent each line
+    # the stage before it prints (see PipeSink) and None at the end. Lines stream through one at a time, so the whole thing runs in constant memory.
+    # Also runs single commands with < > or >>: < feeds the file to the first stage the same way, > and >> send a stage's output to a BlockWriter instead of on.
+    def _pipeline(shell, parts):
+        cio = shell.cio # (_syntax has checked every stage has a command, and every redirection a file)
+        mods = []
+        sinks = [] # every PipeSink and BlockWriter, downstream first
+        sink = None
+        ok = False
+        err = None
+        src = None
+        try:
+            if parts[0]['redirections']['stdin']:
+                src = open(parts[0]['redirections']['stdin'])
+                parts[0]['pipe_from'] = src # its stdin is that file
+            for cmdenv in reversed(parts):
+                cio.pipe = None
+                cmd = cmdenv['args'][0]
+                mod, command_function = shell._cmd_fn('dot' if cmd == '.' else cmd)
+                if command_function is None:
+                    return 1
+                mods.append(mod)
+                out = cmdenv['redirections']['stdout']
+                if out:
+                    sink = cio._writer(out['append'], 'a') if isinstance(out, dict) else cio._writer(out)
+                    sinks.append(sink)
+                cio.pipe = sink # its output goes to the stage after it (or the file)
+                ret = command_function(shell, cmdenv)
+                if cmdenv['pipe_from'] is not None:
+                    gen = ret if hasattr(ret, 'send') else None # None: it doesn't read stdin; what is piped into it is dropped
+                    if gen:
+                        next(gen) # run it up to its first yield
+                    sink = PipeSink(cio, gen, sink)
+                    sinks.append(sink)
+            if src:
+                for line in src:
+                    sink.write(line)
+            ok = True
+        except OSError as e:
+            err = shell.get_desc(10).format('sh', e) # sh: {}
+        finally:
+            try:
+                for s in reversed(sinks): # upstream first, so what each prints at the end still flows down
+                    s.close(ok)
+            finally:
+                cio.pipe = None
+                if src:
+                    src.close()
+                for mod in mods:
+                    shell._unload(mod)
+        if err:
+            print(err)
+            shell._rc = 1
+        return 1
     
 
 
@@ -1271,7 +2277,9 @@ def main():
 
         while run>0:
             run=1
-            user_input = input(shell.subst_env("$GRN$HOSTNAME$NORM:{}\$ ",cache=True).format(os.getcwd())) # the stuff in the middle is the prompt
+            custom_io.busy = None # any session may type the next command
+            user_input = input(shell.prompt())
+            custom_io.busy = custom_io.cur # its command's output and input() stay with it
             if user_input:
                 #print("#############")
                 #print(''.join(f' 0x{ord(c):02X} ' if ord(c) < 0x20 else c for c in user_input))
@@ -1288,6 +2296,8 @@ def main():
                     print("^C")
             if run>1: time.sleep(0.1)  # Perform other tasks here
 
+        shell._unload(flush=True) # so a re-run of import sh loads fresh command modules
+
 
     custom_io.flush()
 
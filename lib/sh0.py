@@ -48,60 +48,100 @@ def df(shell, cmdenv): # 148 bytes - caution: _human_size
         print(shell.get_desc(80).format(_human_size(total_size), _human_size(used_size), _human_size(free_size)))
     except OSError as e:
         shell._ee(cmdenv,e) # print(f"{}: {e}")
-
-
-def ls(shell,cmdenv):   # impliments -F -l -a -t -r -S -h - caution _human_size
-    args=cmdenv['args']
-    tsort=[]
-
-    def list_items(items):
-        for f in sorted(items, reverse=bool(cmdenv['sw'].get('r'))):
-            if (f.startswith('.') or ("/." in f and '/' not in f.split("/.")[-1])) and not cmdenv['sw'].get('a'): continue
-            #print(f"f={f}")
-            if not _file_exists(f):
-                print(shell.get_desc(12).format(cmdenv['args'][0], f))  # ls: cannot access 'sdf': No such file or directory
+        return
+    try: # the biggest directories du last counted (with SH_DUCACHE set)
+        top = []
+        with open('/.du_cache', 'r') as f:
+            for line in f:
+                v = line.split('\t')
+                if len(v) == 4 and v[0] != '/':
+                    top.append((int(v[2]), v[0]))
+                    if len(top) > 20:
+                        top.sort(reverse=True)
+                        del top[10:]
+        top.sort(reverse=True)
+        n = 0
+        for b, p in top:
+            try:
+                os.stat(p)
+            except OSError: # gone since du counted it
                 continue
-            pt = os.stat(f)
-            #mtime = time.localtime(pt[7])
-            mtime = time.gmtime(pt[7])
-            #mtime_str = f"{mtime.tm_year}-{mtime.tm_mon:02}-{mtime.tm_mday:02} {mtime.tm_hour:02}:{mtime.tm_min:02}.{mtime.tm_sec:02}"
-            #mtime[0]-=30
-            mtime_str = f"{mtime[0]}-{mtime[1]:02}-{mtime[2]:02} {mtime[3]:02}:{mtime[4]:02}:{mtime[5]:02}"
-
-            tag = "/" if cmdenv['sw'].get('F') and pt[0] & 0x4000 else ""
-            sz=pt[6]
-            if pt[0] & 0x4000 and ( pt[6]<1 or pt[6]>1000000000):
-                sz=4096 # some filesystem report 1,073,572,116 for folders
-            fsize = _human_size(sz) if cmdenv['sw'].get('h') else sz
-            ret=f"{fsize:,}\t{mtime_str}\t{f}{tag}" if cmdenv['sw'].get('l') else f"{f}{tag}"
-            if cmdenv['sw'].get('t'):
-                tsort.append((pt[7], ret))
-            elif cmdenv['sw'].get('S'):
-                tsort.append((sz, ret))
-            elif cmdenv['sw'].get('s'):
-                tsort.append((-sz, ret))
-            else:
-                print(ret)
-
+            if not n:
+                print(shell.get_desc(91)) # Largest directories (when du last counted them):
+            print(f"{_human_size(b)}\t{p}")
+            n += 1
+            if n == 5:
+                break
+    except (OSError, ValueError):
+        pass
+
+
+def _ls_fmt(sw, f, typ, sz, mt): # one ls output line
+    tag = "/" if sw.get('F') and typ & 0x4000 else ""
+    if not sw.get('l'):
+        return f"{f}{tag}"
+    if typ & 0x4000 and (sz < 1 or sz > 1000000000):
+        sz = 4096 # some filesystem report 1,073,572,116 for folders
+    fsize = _human_size(sz) if sw.get('h') else f"{sz:,}"
+    mtime = time.gmtime(mt)
+    return f"{fsize}\t{mtime[0]}-{mtime[1]:02}-{mtime[2]:02} {mtime[3]:02}:{mtime[4]:02}:{mtime[5]:02}\t{f}{tag}"
+
+
+def _ls_dir(shell, sw, path, hdr): # list one directory (path '' is /) from os.ilistdir: an entry is only stat'ed if -l or -t needs its mtime (or the port gives no size). -R: then each subdirectory, as we go
+    if hdr:
+        print(f"\n{path or '/'}:")
+    pre = f"{path}/" if path else ""
+    names = []
+    typ = []
+    size = []
+    mt = []
+    for e in os.ilistdir(path or '/'):
+        if e[0].startswith('.') and not sw.get('a'):
+            continue
+        names.append(e[0])
+        typ.append(e[1])
+        sz = e[3] if len(e) > 3 else -1
+        t = 0
+        if sw.get('l') or sw.get('t') or sz < 0:
+            try:
+                st = os.stat(pre + e[0] if path else '/' + e[0])
+                sz = st[6]
+                t = st[8]
+            except OSError:
+                pass
+        size.append(sz)
+        mt.append(t)
+    keys = mt if sw.get('t') else size if sw.get('S') or sw.get('s') else None
+    order = sorted([(k, i) for i, k in enumerate(names)], reverse=bool(sw.get('r')) and keys is None) # (key, index) pairs, not output lines
+    if keys is not None: # -t -S: biggest first (-s: smallest), then by name
+        order = sorted([(-keys[i] if sw.get('s') else keys[i], -n, i) for n, (_, i) in enumerate(order)], reverse=not sw.get('r'))
+    for k in order:
+        i = k[-1]
+        print(_ls_fmt(sw, pre + names[i], typ[i], size[i], mt[i]))
+    if sw.get('R'): # only the subdirectory names are kept while we go down into them
+        subs = [names[k[-1]] for k in order if typ[k[-1]] & 0x4000]
+        names = typ = size = mt = keys = order = None
+        for n in subs:
+            _ls_dir(shell, sw, pre + n if path else '/' + n, True)
+
+
+def ls(shell,cmdenv):   # impliments -F -l -a -t -r -S -s -h -R - caution _human_size
+    sw = cmdenv['sw']
     for path in cmdenv['args'][1:] if len(cmdenv['args']) > 1 else [os.getcwd()]:
- 
         path=_bare(path) # cannot stat("foo/")
         try:
-            fstat = os.stat(path)
-            if fstat[0] & 0x4000:  # Check for directory bit
-                if path.endswith("/"):
-                    path = path[:-1]
-                path_pre = f"{path}/" if path else ""
-    
-                list_items([f"{path_pre}{filename}" for filename in os.listdir(path)])
-            else:
-                list_items([path])
+            st = os.stat(path)
         except OSError:
-            print(f"{path} Not found")  # Handle non-existent paths
-
-    if cmdenv['sw'].get('t') or cmdenv['sw'].get('S') or cmdenv['sw'].get('s'):
-        for _, ret in sorted(tsort, reverse=not bool(cmdenv['sw'].get('r'))):
-            print(ret)
+            print(shell.get_desc(12).format(cmdenv['args'][0], path))  # ls: cannot access 'sdf': No such file or directory
+            shell._rc = 1
+            continue
+        try:
+            if st[0] & 0x4000:  # Check for directory bit
+                _ls_dir(shell, sw, path.rstrip('/'), sw.get('R') and len(cmdenv['args']) > 2)
+            else:
+                print(_ls_fmt(sw, path, st[0], st[6], st[8]))
+        except OSError as e:
+            shell._ee(cmdenv, e)
 
 
 def cd(shell, cmdenv):
@@ -115,12 +155,79 @@ def cd(shell, cmdenv):
 
 
 def _cp(shell, src, tgt, cmdenv):
+    sw = cmdenv['sw']
+    cs = [None, 0, 0, time.ticks_ms()] # buffer, bytes copied, files copied, ticks_ms started
     try:
-        with open(src, 'rb') as src_file:
-                with open(tgt, 'wb') as dest_file:  # OSError: [Errno 30] Read-only filesystem
-                    dest_file.write(src_file.read())
+        if os.stat(src)[0] & 0x4000:
+            if not (sw.get('r') or sw.get('a')):
+                print(shell.get_desc(87).format(cmdenv['args'][0], src)) # cp: -r not specified; omitting directory '{}'
+                shell._rc = 1
+            elif (tgt.rstrip('/') + '/').startswith(src.rstrip('/') + '/'):
+                print(shell.get_desc(88).format(cmdenv['args'][0], src, tgt)) # cp: cannot copy a directory, '{}', into itself, '{}'
+                shell._rc = 1
+            else:
+                src = src.rstrip('/')
+                tgt = tgt.rstrip('/')
+                for p, typ, _, _ in shell._walk(src): # directories come before what is in them
+                    t = tgt + p[len(src):]
+                    try:
+                        if typ == 0x4000:
+                            if not _file_exists(t):
+                                os.mkdir(t)
+                        else:
+                            _cpf(shell, p, t, sw, cs)
+                    except OSError as e:
+                        shell._ee(cmdenv, e)
+        else:
+            _cpf(shell, src, tgt, sw, cs)
     except OSError as e:
         shell._ee(cmdenv, e)  # print(f"mv: {e}")
+    if sw.get('v'):
+        ms = max(1, time.ticks_diff(time.ticks_ms(), cs[3]))
+        print(shell.get_desc(89).format(cs[1], cs[2], ms, cs[1] * 1000 // 1024 // ms)) # {} bytes in {} files, {}ms ({}KB/s)
+
+
+def _cpf(shell, src, tgt, sw, cs): # stream one file through cs's buffer (one filesystem block); -p or -a: with src's mtime (sh2._reset_time sets the clock to it while tgt is opened and closed)
+    if cs[0] is None:
+        try:
+            bs = os.statvfs(tgt.rsplit('/', 1)[0] or '/')[0]
+        except OSError:
+            bs = 0
+        cs[0] = bytearray(min(bs or 512, int(shell.os_getenv('SH_WRBUF', 4096))))
+    buf = cs[0]
+    mv = memoryview(buf)
+    keep = sw.get('p') or sw.get('a')
+    if keep:
+        import sh2
+        ft = sh2._ftime(shell, src, 1)
+    with open(src, 'rb') as src_file:
+        if keep:
+            tr = sh2._reset_time(ft, 0)
+        try:
+            dest_file = open(tgt, 'wb')  # OSError: [Errno 30] Read-only filesystem
+        finally:
+            if keep:
+                sh2._reset_time(tr, 1)
+        try:
+            while True:
+                n = src_file.readinto(buf)
+                if not n:
+                    break
+                dest_file.write(mv[:n])
+                cs[1] += n
+        finally:
+            if keep:
+                tr = sh2._reset_time(ft, 0)
+            try:
+                dest_file.close()
+            finally:
+                if keep:
+                    sh2._reset_time(tr, 1)
+    cs[2] += 1
+    if keep:
+        shell._unload('sh2')
+    if sw.get('v'):
+        print(f"'{src}' -> '{tgt}'")
 
 
 def _confirm_overwrite(shell, filename):
@@ -143,7 +250,7 @@ def mv(shell, cmdenv):
             if target.endswith("/"):
                 target = target[:-1]
             for path in cmdenv['args'][1:-1]:
-                dest = target + '/' + path
+                dest = target + '/' + path.rstrip('/').rsplit('/', 1)[-1]
                 if interactive and _file_exists(dest):
                     if not _confirm_overwrite(shell, dest):
                         continue
@@ -177,14 +284,36 @@ def rm(shell, cmdenv):
     if len(cmdenv['args']) < 2:
         shell._ea(cmdenv) # print("rm: missing file operand")
     else:
+        sw = cmdenv['sw']
         for path in cmdenv['args'][1:]:
             try:
                 if os.stat(path)[0] & 0x4000:  # Check if it's a directory
-                    os.rmdir(path.rstrip('/'))
+                    if sw.get('r') or sw.get('R'):
+                        _rm_r(shell, path)
+                    else:
+                        os.rmdir(path.rstrip('/'))
                 else:
                     os.remove(path.rstrip('/'))
             except OSError as e:
-                shell._ee(cmdenv,e) # print(f"rm: {e}")
+                if not (sw.get('f') and e.args[0] == 2):
+                    shell._ee(cmdenv,e) # print(f"rm: {e}")
+
+
+def _rm_r(shell, path): # rm -r: the walker gives what is in a directory before the directory. Removing entries while their directory is being listed can make the listing skip some, so go round again while that gets anywhere
+    while _file_exists(path):
+        n = 0
+        err = None
+        for p, typ, _, _ in shell._walk(path, post=True):
+            try:
+                if typ == 0x4000:
+                    os.rmdir(p)
+                else:
+                    os.remove(p)
+                n += 1
+            except OSError as e:
+                err = e
+        if not n:
+            raise err
 
 
 def mkdir(shell, cmdenv):
@@ -58,34 +58,40 @@ def man(shell,cmdenv):
         print(shell.get_desc(2))                       # "Usage: man [keyword]"
 
 
-def _iter_cmds():
-    for mod in ["sh0", "sh1", "sh2", "sh3"]:
+def _own(module, mod, o): # a command: a function or class defined in module itself, not one it imported
+    return callable(o) and getattr(o, '__module__', mod) == mod and getattr(o, '__globals__', module.__dict__) is module.__dict__
+
+
+def _mk_cmds(shell, mods): # Caution: this must live in sh1.py (called from sh.py) - (re)builds shell.cmds_file by importing every command module once
+    cmods = []
+    lines = []
+    for mod in mods:
         gc.collect()
-        module = __import__(mod)
-        for name in dir(module):
-            if not name.startswith("_"):
-                obj = getattr(module, name)
-                if callable(obj):
-                    yield name
+        try:
+            module = __import__(mod)
+        except ImportError:
+            continue
+        names = ' '.join(sorted(name for name in dir(module) if not name.startswith("_") and _own(module, mod, getattr(module, name)))) # (the same rule as tools/mkcmds.py)
+        cmods.append([mod, f" {names} "])
+        lines.append(f"{mod}\t{shell._mod_size(mod)}\t{names}\n")
         if mod != "sh1":
             del sys.modules[mod]
         gc.collect()
+    try:
+        with open(shell.cmds_file, 'w') as file:
+            for line in lines:
+                file.write(line)
+    except OSError:
+        pass # read-only filesystem; the in-RAM copy still works for this session
+    return cmods
 
 
 def help(shell, cmdenv):
     try:
         commands = []
-        for mod in ["sh0", "sh1", "sh2", "sh3"]:
-            gc.collect()
-            module = __import__(mod)
-            for name in dir(module):
-                if not name.startswith("_"):
-                    obj = getattr(module, name)
-                    if callable(obj):
-                        commands.append(name)
-            if mod != "sh1":
-                del sys.modules[mod]
-            gc.collect()
+        for cmd in shell._cmds():
+            if cmd not in commands:
+                commands.append(cmd)
 
         if cmdenv.get('args', [])[1:] == ["all"]:
             for cmd in sorted(commands):
@@ -109,10 +115,9 @@ def which(shell, cmdenv):
 
     # Check for inbuilt commands
     try:
-        for cmd in _iter_cmds():
-            if command == cmd:
-                print(f"{command}: (inbuilt)")
-                return
+        if shell._cmd_mod(command):
+            print(f"{command}: (inbuilt)")
+            return
     except Exception as e:
         print(f"Error checking inbuilt commands: {e}")
 
@@ -140,66 +145,215 @@ def which(shell, cmdenv):
     print(f"{command}: command not found")
 
 
-def run(shell,cmdenv):
+def _blocks(f): # yields (first line number, source) for each top-level statement of a Python file, with everything that belongs to it: indented lines, open brackets and strings, \ continuations, else/elif/except/finally, the def after a decorator
+    block = []
+    first = n = depth = 0
+    q = ''        # open string quote, carried to the next line
+    cont = False  # the last line ended with \
+    deco = False  # the last top-level line was a decorator
+    for line in f:
+        n += 1
+        if not (q or depth or cont):
+            s = line.lstrip()
+            if not s or s[0] == '#':
+                if block:
+                    block.append('\n') # (keeps line numbers right)
+                continue
+            if line[0] not in ' \t':
+                k = 0
+                while k < len(s) and (s[k].isalpha() or s[k] == '_'):
+                    k += 1
+                if block and not deco and s[:k] not in ('else', 'elif', 'except', 'finally'):
+                    yield first, ''.join(block)
+                    block = []
+                deco = s[0] == '@'
+            if not block:
+                first = n
+        block.append(line)
+        cont = False
+        i = 0
+        while i < len(line):
+            c = line[i]
+            if q:
+                if c == '\\':
+                    i += 1
+                elif line.startswith(q, i):
+                    i += len(q) - 1
+                    q = ''
+            elif c == '#':
+                break
+            elif c in '"\'':
+                q = c * 3 if line.startswith(c * 3, i) else c
+                i += len(q) - 1
+            elif c in '([{':
+                depth += 1
+            elif c in ')]}':
+                depth = max(0, depth - 1)
+            elif c == '\\' and not line[i + 1:].strip():
+                cont = True
+            i += 1
+        if len(q) == 1 and not line.endswith('\\\n'):
+            q = '' # unterminated '...' (compile will say so)
+    if block:
+        yield first, ''.join(block)
+
+
+def run(shell,cmdenv): # each top-level statement is compiled once and run; the code is kept in <file>c (when this MicroPython has marshal) and used instead while the file's size and mtime stay the same
     if len(cmdenv['args']) < 2:
         shell._ea(cmdenv)
         return
 
+    import struct
     file_path = cmdenv['args'][1]
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        return shell._ee(cmdenv, e)
+    sig = struct.pack('<II', st[6], st[8])
+    cache = file_path + 'c'
+    g = {'__name__': '__main__', '__file__': file_path}
+    try:
+        import marshal
+    except ImportError:
+        marshal = None
 
-    in_docstring = False
-    block = ""
-    extra_iteration = False
-
-    with open(file_path, 'r') as f:
-        while True:
-            if not extra_iteration:
-                line = f.readline()
-
-                if cmdenv['args'][0]=='.': # run a "sh" script
-                    if not line: break
-                    print(line)
-                    shell.execute_command(line)
-                    continue
-
-                if not line:
-                    extra_iteration = True
-                    line = '\n'  # Trigger the final block execution
-
-            else:
-                break
-
-            stripped_line = line.strip()
-
-            if in_docstring:
-                if stripped_line.endswith('"""') or stripped_line.endswith("'''"):
-                    in_docstring = False
-                continue
-
-            if stripped_line.startswith('"""') or stripped_line.startswith("'''"):
-                in_docstring = True
-                continue
-
-            if '#' in line:
-                line = line.split('#', 1)[0]
+    if marshal:
+        try:
+            f = open(cache, 'rb')
+        except OSError:
+            f = None
+        codes = None
+        if f:
+            with f:
+                if f.read(8) == sig:
+                    codes = []
+                    ct = type(compile('0', cache, 'exec'))
+                    try: # all loaded before any runs: a bad cache (other firmware, cut short) is just compiled again
+                        while True:
+                            h = f.read(4)
+                            if not h:
+                                break
+                            codes.append(marshal.loads(f.read(struct.unpack('<I', h)[0])))
+                            if type(codes[-1]) is not ct:
+                                raise ValueError(cache)
+                    except Exception:
+                        codes = False
+        if codes is False:
+            try:
+                os.remove(cache)
+            except OSError:
+                pass
+        elif codes is not None:
+            for code in codes:
+                exec(code, g)
+            return
 
-            if line.strip():
-                block += line + '\n'
+    out = None
+    if marshal:
+        try:
+            out = open(cache, 'wb')
+            out.write(sig)
+        except OSError:
+            out = None
+    ok = False
+    try:
+        with open(file_path, 'r') as f:
+            block = ''
+            for first, src in _blocks(f):
+                if not block:
+                    start = first
+                block += src
                 try:
-                    exec(block)
-                    block = ""
+                    code = compile(block, file_path, 'exec')
                 except SyntaxError:
-                    # If compile fails, continue adding lines to the block
+                    continue # not a whole statement after all: carry on adding to it, progressive-compilation style
+                block = ''
+                if out:
+                    try:
+                        data = marshal.dumps(code)
+                        out.write(struct.pack('<I', len(data)))
+                        out.write(data)
+                    except (ValueError, OSError): # can't be saved; just run
+                        out.close()
+                        out = None
+                        os.remove(cache)
+                exec(code, g)
+            if block:
+                try:
+                    compile(block, file_path, 'exec')
+                except SyntaxError as e: # (its line number counts from the block's first line, start)
+                    return shell._ee(cmdenv, '{} (line {})'.format(e.args[0] if e.args else e, start - 1 + (getattr(e, 'lineno', None) or 1)))
+        ok = True
+    finally:
+        if out:
+            out.close()
+            if not ok:
+                os.remove(cache)
+
+
+def _script(shell, path): # a . script parsed once: [[line, parse_command_line() result], ...], the result None for lines with $ or ` (expanded as they run). Cached in <path>c, keyed by the size and mtime of the script, settings.toml and its journal (aliases)
+    import json
+    st = os.stat(path)
+    sig = [st[6], st[8]]
+    for t in shell._tsig([shell.settings_file, shell._jnl(shell.settings_file)]):
+        sig += t
+    try:
+        with open(path + 'c') as f:
+            c = json.load(f)
+        if c['sig'] == sig:
+            return c['cmds']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    cmds = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            if '$' in line or '`' in line:
+                cmds.append([line, None])
+            else:
+                parts = shell.parse_command_line(line)
+                if not (shell._pcache and shell._pcache[0][0] == line): # an alias with $ or ` in it: expanded each time it runs
+                    cmds.append([line, None])
                     continue
-                #except Exception as e:
-                #    print(f"Error executing block: {e}")
-                #    break
+                for d in parts:
+                    if d['pipe_from'] is not None:
+                        d['pipe_from'] = True # (_pcopy puts the link back)
+                cmds.append([line, parts])
+    try:
+        with open(path + 'c', 'w') as f:
+            json.dump({'sig': sig, 'cmds': cmds}, f)
+    except OSError:
+        pass
+    return cmds
 
 
+def dot(shell, cmdenv): # . <script> [-x]: run a file of shell commands, parsed once, with the command modules it uses kept loaded until it ends
+    if len(cmdenv['args']) < 2:
+        return shell._ea(cmdenv)
+    try:
+        cmds = _script(shell, cmdenv['args'][1])
+    except OSError as e:
+        return shell._ee(cmdenv, e)
+    shell._hold += 1
+    try:
+        for line, parts in cmds:
+            if cmdenv['sw'].get('x'):
+                print('+ ' + line)
+            try:
+                if not (shell.execute_command(line) if parts is None else shell._run(shell._pcopy(parts))):
+                    break # exit ends the script
+            except Exception as e:
+                print(shell.get_desc(10).format(line.split()[0], e)) # {}: {}
+                shell._rc = 1
+    finally:
+        shell._hold -= 1
+        shell._unload()
+
 
-def dot(shell, cmdenv):
-    cmdenv['args'][0]='.'
-    run(shell,cmdenv)
+def sh(shell, cmdenv): # sh <script>: same as .
+    return dot(shell, cmdenv)
 
 
 # def test(shell,cmdenv):
@@ -340,36 +494,86 @@ def edit(shell, cmdenv):
         try:
             import pye
             pye.pye(cmdenv['args'][1])
-            del sys.modules['pye']
+            shell._unload('pye')
         except Exception as e:
             shell._ee(cmdenv, e)  # print(f"edit: {e}")
 
 
+def _cat_in(): # cat with no files at the end of a pipe: copy stdin through
+    while True:
+        line = yield
+        if line is None:
+            return
+        print(line, end='')
+
+
 def cat(shell, cmdenv):
+    if cmdenv.get('pipe_from') is not None and len(cmdenv['args']) < 2:
+        return _cat_in()
     if len(cmdenv['args']) < 2:
         shell._ea(cmdenv)  # print("cat: missing file operand")
     else:
+        buf = bytearray(int(shell.os_getenv('SH_RDBUF', 2048))) # read into this and sent on as bytes (see CustomIO.send_bytes), so any file can be cat'ed
+        mv = memoryview(buf)
         for path in cmdenv['args'][1:]:
             try:
                 with open(path, 'rb') as file:
                     while True:
-                        chunk = file.read(64)
-                        if not chunk:
+                        n = file.readinto(buf)
+                        if not n:
                             break
-                        print(chunk.decode('utf-8'), end='')
+                        shell.cio.send_bytes(mv[:n])
             except Exception as e:
                 shell._ee(cmdenv, e)  # print(f"cat: {e}")
+            finally:
+                shell.cio.send_bytes(None)
+
+def _kvs(text): # 'a=1 b="x y" c=ls -l' -> {'a': '1', 'b': '"x y"', 'c': 'ls -l'}: a word with an = starts the next pair, other words belong to the value before
+    words = []
+    w = ''
+    q = ''
+    for ch in text:
+        if q:
+            q = '' if ch == q else q
+        elif ch in '"\'':
+            q = ch
+        elif ch == ' ':
+            if w:
+                words.append(w)
+            w = ''
+            continue
+        w += ch
+    if w:
+        words.append(w)
+    ret = {}
+    key = None
+    for w in words:
+        k = w.split('=', 1)[0]
+        if '=' in w and k and k[0] not in '"\'-':
+            key = k
+            ret[key] = w[len(k) + 1:]
+        elif key is not None:
+            ret[key] += ' ' + w
+    return ret
+
+
+def _isnum(v):
+    try:
+        float(v)
+        return True
+    except ValueError:
+        return False
+
 
 def alias(shell, cmdenv):
-    if len(cmdenv['args']) < 2:
-        cat(shell, {'sw': {}, 'args': ['alias', '/settings.toml']}) # all aliases are stored in /settings.toml
-        #shell._ea(cmdenv)
+    if len(cmdenv['args']) < 2: # all aliases and variables: /settings.toml with its journal applied
+        for k, v in shell._toml_idx(shell.settings_file).items(): # (values come decoded: lists, tables and numbers print bare, strings in quotes)
+            print(f"{k} = {v}" if v[:1] in '[{(' or _isnum(v) else f'{k} = "{v}"')
         return
     if "=" not in cmdenv['line']:
         print(shell._rw_toml('r',[cmdenv['args'][-1]])) # print existing
-    else:
-        key, value = cmdenv['line'].split(' ', 1)[1].strip().split('=', 1) # discard the prefix. Note that the = is not allowed to have spaces.
-        shell._rw_toml('w', [key], value)
+    else: # any number of key=value, saved with one rewrite (see _tx_toml). Note that the = is not allowed to have spaces.
+        shell._tx_toml(_kvs(cmdenv['line'].split(' ', 1)[1].strip())) # discard the prefix
 
 def export(shell, cmdenv):
     alias(shell, cmdenv)  # same as alias
@@ -436,8 +640,43 @@ def telnetd(shell, cmdenv): # usage: telnetd --port=23
     shell.cio.telnetd(shell,cmdenv['sw'].get('port', 23)) # tell our shell to open up the listening socket
 
 
-def sort(shell,cmdenv):  # 53 bytes
-    return "\n".join(sorted(cmdenv['args'][1:], reverse='-r' in cmdenv['sw']))
+def _num(line): # sort -n key: the leading number (0 if there isn't one)
+    try:
+        return float(line.split()[0])
+    except (ValueError, IndexError):
+        return 0
+
+
+def _sort_in(sp): # sort at the end of a pipe: everything has to arrive before the first line can go out
+    try:
+        while True:
+            line = yield
+            if line is None:
+                break
+            sp.add(line)
+        for line in sp:
+            print(line, end='')
+    finally:
+        sp.close()
+
+
+def sort(shell,cmdenv):
+    sp = shell._spool(_num if 'n' in cmdenv['sw'] else None, 'r' in cmdenv['sw'])
+    if cmdenv['pipe_from'] is not None and len(cmdenv['args']) < 2:
+        return _sort_in(sp)
+    if len(cmdenv['args']) < 2:
+        return shell._ea(cmdenv)  # print("sort: missing file operand")
+    try:
+        for path in cmdenv['args'][1:]:
+            with open(path) as f:
+                for line in f:
+                    sp.add(line)
+        for line in sp:
+            print(line, end='')
+    except Exception as e:
+        shell._ee(cmdenv, e)  # print(f"sort: {e}")
+    finally:
+        sp.close()
 
 
 def clear(shell, cmdenv):
@@ -376,6 +376,7 @@ def shupdate(shell, cmdenv):
         cmdenv['sw']['output']=fn
         curl(shell, cmdenv)
     print(shell.get_desc(38)) # re-run import shell to re-start the updated shell
+    shell._unload(flush=True) # drop any resident (old) command modules
     del sys.modules["sh"] # so we can re-run us later
     raise OSError( shell.get_desc(38) )
 
@@ -393,20 +394,13 @@ def backup(shell, cmdenv):
         cmdenv['sw']['q']=True
         curl(shell, cmdenv)
 
-    def do_or_send(path,url):
-        if os.stat(path)[0] & 0x4000: # if os.path.isdir(full_path):
-            spider(path,url)
-        else:
-            bsend(path,url)
-   
-    def spider(path,url):
-        for entry in os.listdir(path):
-            full_path = path + "/" + entry if path != "/" else "/" + entry # full_path = os.path.join(path, entry)
-            do_or_send(full_path,url)
-
     for path in cmdenv['args'][1:] if len(cmdenv['args']) > 1 else [os.getcwd()]:
-        do_or_send(path,burl)
-        # spider("/",burl)
+        try:
+            for fn, typ, _, _ in shell._walk(path): # every file in every folder, without recursion
+                if typ != 0x4000:
+                    bsend(fn,burl)
+        except OSError as e:
+            shell._ee(cmdenv, e)
 
 
 
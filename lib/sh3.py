@@ -56,26 +56,74 @@ def ifconfig(shell, cmdenv): # 567b
         #del sys.modules["mdns"] # done. save space now.
 
 
-def wc(shell, cmdenv): # 249 bytes
+def _wc_add(c, b, lc=False): # count the bytes b (a memoryview of the read buffer, or bytes) into c: [lines, words, chars, bytes, in a word], one byte at a time in place, so no copies are made
+    if lc: # only lines and bytes wanted: one bytes.count does it (a copy of b, but far quicker than the loop)
+        c[0] += (b if isinstance(b, bytes) else bytes(b)).count(b'\n')
+        c[3] += len(b)
+        return
+    l, w, m, inw = c[0], c[1], c[2], c[4]
+    for x in b:
+        if x == 10:
+            l += 1
+        if x == 32 or 9 <= x <= 13: # whitespace ends a word
+            inw = False
+        elif not inw:
+            w += 1
+            inw = True
+        if x & 0xC0 != 0x80: # a char starts at each byte but a UTF-8 continuation byte
+            m += 1
+    c[0], c[1], c[2], c[4] = l, w, m, inw
+    c[3] += len(b)
+
+
+def _wc_out(c, sw, name=''):
+    print(' '.join([str(c[i]) for i, k in ((0, 'l'), (1, 'w'), (2, 'm'), (3, 'c')) if sw.get(k)] + ([name] if name else [])))
+
+
+def _wc_lc(sw): # neither -w nor -m: words and chars needn't be counted
+    return not (sw.get('w') or sw.get('m'))
+
+
+def _wc_in(sw): # wc with no file at the end of a pipe: count stdin
+    c = [0, 0, 0, 0, False]
+    lc = _wc_lc(sw)
+    while True:
+        line = yield
+        if line is None:
+            break
+        _wc_add(c, line.encode('utf-8'), lc)
+    _wc_out(c, sw)
+
+
+def wc(shell, cmdenv): # wc [-l] [-w] [-m] [-c] [file ...]: lines, words, chars, bytes (-l -w -c when none are given) and a total for more than one file
+    sw = cmdenv['sw']
+    if not (sw.get('l') or sw.get('w') or sw.get('m') or sw.get('c')):
+        sw = {'l': True, 'w': True, 'c': True}
+    if cmdenv['pipe_from'] is not None and len(cmdenv['args']) < 2:
+        return _wc_in(sw)
     if len(cmdenv['args']) < 2:
         shell._ea(cmdenv)  # print("wc: missing file operand")
     else:
-        path = cmdenv['args'][1]
-        try:
-            with open(path, 'rb') as file:
-                lines = 0
-                words = 0
-                bytes_count = 0
-                while True:
-                    chunk = file.read(512)
-                    if not chunk:
-                        break
-                    lines += chunk.count(b'\n')
-                    words += len(chunk.split())
-                    bytes_count += len(chunk)
-                print(f"{lines} {words} {bytes_count} {path}")
-        except Exception as e:
-            shell._ee(cmdenv, e)  # print(f"wc: {e}")
+        buf = bytearray(int(shell.os_getenv('SH_RDBUF', 2048))) # every file is read into this one buffer
+        mv = memoryview(buf)
+        lc = _wc_lc(sw)
+        t = [0, 0, 0, 0]
+        for path in cmdenv['args'][1:]:
+            c = [0, 0, 0, 0, False]
+            try:
+                with open(path, 'rb') as file:
+                    while True:
+                        n = file.readinto(buf)
+                        if not n:
+                            break
+                        _wc_add(c, mv[:n], lc)
+                _wc_out(c, sw, path)
+                for i in range(4):
+                    t[i] += c[i]
+            except Exception as e:
+                shell._ee(cmdenv, e)  # print(f"wc: {e}")
+        if len(cmdenv['args']) > 2:
+            _wc_out(t, sw, 'total')
 
 
 def set_time(shell, cmdenv):
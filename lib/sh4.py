@@ -0,0 +1,519 @@
+# sh4.py
+
+__version__ = '1.0.20261018'  # Major.Minor.Patch
+
+# Created by Chris Drake.
+# Linux-like shell interface for MicroPython.  https://github.com/gitcnd/mpy_shell
+#
+# This is a separate module for holding some commands.
+# it is separate to save RAM
+
+import os
+import time
+
+
+def _human_size(size): # same as sh0's (not imported from there, to save RAM)
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if size < 1024:
+            return f"{round(size):,}{unit}"
+        size /= 1024
+    return f"{round(size):,}P"
+
+
+def _fnmatch(name, pat): # glob match: * any run of chars, ? any one char
+    n = p = 0
+    star = -1
+    mark = 0
+    while n < len(name):
+        if p < len(pat) and (pat[p] == '?' or pat[p] == name[n]):
+            n += 1
+            p += 1
+        elif p < len(pat) and pat[p] == '*':
+            star = p # remember it, and try matching nothing first
+            mark = n
+            p += 1
+        elif star >= 0: # let the last * take one more char
+            p = star + 1
+            mark += 1
+            n = mark
+        else:
+            return False
+    while p < len(pat) and pat[p] == '*':
+        p += 1
+    return p == len(pat)
+
+
+def _num(spec): # find's numeric argument: +N more than N, -N less than N, N exactly N. (sign, N); ValueError if it isn't one
+    sign = spec[:1] if spec[:1] in '+-' else ''
+    n = spec[len(sign):]
+    if not n.isdigit():
+        raise ValueError(spec)
+    return sign, int(n)
+
+
+def _cmp(t, v): # t: (sign, N) from _num
+    if t[0] == '+':
+        return v > t[1]
+    if t[0] == '-':
+        return v < t[1]
+    return v == t[1]
+
+
+def find(shell, cmdenv): # find [path ...] [-name glob] [-type f|d] [-size [+-]N[ckM]] [-mtime [+-]N] [-maxdepth N] [-exec cmd {} ;]
+    tok = [t[1:-1] if len(t) > 1 and t[0] == t[-1] and t[0] in '"\'' else t for t in cmdenv['line'].split()[1:]] # the shell takes -name etc. for switches, so read the line
+    paths = []
+    while tok and not tok[0].startswith('-'):
+        paths.append(tok.pop(0))
+    tests = []
+    maxdepth = -1
+    exe = None
+    i = 0
+    try:
+        while i < len(tok):
+            t = tok[i]
+            if t == '-print':
+                i += 1
+                continue
+            if t == '-exec': # to the end of the line (the shell has already taken a ; as the end of the command)
+                exe = [a for a in tok[i + 1:] if a not in (';', '\\;', '+')]
+                break
+            v = tok[i + 1]
+            if t == '-name':
+                tests.append((0, v))
+            elif t == '-type':
+                tests.append((1, 0x4000 if v == 'd' else 0x8000))
+            elif t == '-size': # in 512-byte blocks, or c (bytes) k M, rounded up
+                u = {'c': 1, 'k': 1024, 'M': 1048576}.get(v[-1], 0)
+                tests.append((2, _num(v[:-1] if u else v), u or 512))
+            elif t == '-mtime': # in days
+                tests.append((3, _num(v)))
+            elif t == '-maxdepth':
+                maxdepth = int(v)
+            else:
+                raise ValueError(t)
+            i += 2
+    except (IndexError, ValueError):
+        print(shell.get_desc(90).format(cmdenv['args'][0], tok[i])) # find: bad or incomplete test `{}'
+        shell._rc = 1
+        return
+    now = time.time()
+    stat = any(t[0] == 3 for t in tests) # only -mtime needs each entry stat'ed
+    if exe:
+        shell._hold += 1 # keep the modules -exec runs loaded, as for a script
+    try:
+        for top in paths or ['.']:
+            try:
+                for p, typ, size, mt in shell._walk(top, maxdepth, stat=stat):
+                    for t in tests:
+                        if t[0] == 0:
+                            ok = _fnmatch(p.rsplit('/', 1)[-1] or p, t[1])
+                        elif t[0] == 1:
+                            ok = typ == t[1]
+                        elif t[0] == 2:
+                            ok = _cmp(t[1], (size + t[2] - 1) // t[2])
+                        else:
+                            ok = _cmp(t[1], int(now - mt) // 86400)
+                        if not ok:
+                            break
+                    else:
+                        if exe:
+                            shell.execute_command(' '.join(a.replace('{}', p) for a in exe))
+                        else:
+                            print(p)
+            except OSError as e:
+                shell._ee(cmdenv, e)  # print(f"find: {e}")
+    finally:
+        if exe:
+            shell._hold -= 1
+
+
+def _du_cache(shell, save=None): # /.du_cache: one "path<tab>directory mtime<tab>bytes in it and below<tab>time.time() counted" line per directory. Returns {path: [mtime, bytes, when]}, or writes save
+    fn = '/.du_cache'
+    if save is not None:
+        with open(fn, 'w') as f:
+            for k, v in save.items():
+                f.write(f"{k}\t{v[0]}\t{v[1]}\t{v[2]}\n")
+        return
+    ret = {}
+    try:
+        with open(fn, 'r') as f:
+            for line in f:
+                v = line.rstrip('\n').split('\t')
+                if len(v) == 4:
+                    ret[v[0]] = [int(v[1]), int(v[2]), int(v[3])]
+    except (OSError, ValueError):
+        pass
+    return ret
+
+
+def du(shell, cmdenv): # du [-s] [-h] [-d N] [path ...]: bytes in each directory and below, from os.ilistdir sizes (nothing is stat'ed but directories, and those only for the cache)
+    sw = cmdenv['sw']
+    args = cmdenv['args'][1:]
+    maxd = 0 if sw.get('s') else int(sw.get('max-depth') or _nopt(cmdenv, 'd', args) or -1)
+    age = int(shell.os_getenv('SH_DUCACHE', 0)) # >0: a directory with the same mtime, counted less than this many seconds ago, is taken from /.du_cache instead of walked
+    cache = _du_cache(shell) if age else None
+    now = int(time.time())
+    new = {}  # directories counted this time: [mtime, bytes, when]
+    hit = {}  # path: bytes, for directories answered from the cache
+    walked = [] # tops walked right through: cached directories below them that weren't seen have gone
+    held = []   # cache hits + '/': what is below those wasn't looked at, so stays cached
+    for top in args or ['.']:
+        if len(top) > 1:
+            top = top.rstrip('/')
+        absd = top if top.startswith('/') else os.getcwd().rstrip('/') + '/' + top
+        if absd.endswith('/.'):
+            absd = absd[:-2] or '/'
+        base = top.rstrip('/').count('/')
+
+        def prune(e): # in the cache and unchanged, with nothing below it to print: don't go in
+            if cache is None:
+                return False
+            k = absd + e[0][len(top):] if e[0] != top else absd
+            mt = os.stat(e[0])[8]
+            new[k] = [mt, 0, now]
+            c = cache.get(k)
+            if c and c[0] == mt and now - c[2] < age and 0 <= maxd <= (0 if e[0] == top else e[0].count('/') - base):
+                hit[e[0]] = c[1]
+                new[k] = c
+                held.append(k.rstrip('/') + '/')
+                return True
+            return False
+
+        acc = [0] # bytes so far in the directory at each depth
+        try:
+            for p, typ, size, _ in shell._walk(top, prune=prune, post=True): # a directory comes after what is in it
+                d = 0 if p == top else p.count('/') - base
+                while len(acc) <= d + 1:
+                    acc.append(0)
+                if typ != 0x4000:
+                    if d == 0: # du of a file
+                        print(f"{_human_size(size) if sw.get('h') else size}\t{p}")
+                        continue
+                    acc[d] += size
+                    continue
+                size = acc[d + 1] + hit.pop(p, 0)
+                acc[d + 1] = 0
+                acc[d] += size
+                if cache is not None:
+                    k = absd + p[len(top):] if p != top else absd
+                    if new[k][2] == now: # counted now rather than taken from the cache
+                        new[k][1] = size
+                if maxd < 0 or d <= maxd:
+                    print(f"{_human_size(size) if sw.get('h') else size}\t{p}")
+            walked.append(absd.rstrip('/') + '/')
+        except OSError as e:
+            shell._ee(cmdenv, e)  # print(f"du: {e}")
+    if cache is not None and new:
+        for k in list(cache):
+            if k not in new and any(k.startswith(a) for a in walked) and not any(k.startswith(h) for h in held):
+                del cache[k]
+        cache.update(new)
+        try:
+            _du_cache(shell, cache)
+        except OSError:
+            pass
+
+
+def _dec(b): # bytes of a line to print: UTF-8, or a char per byte if it isn't
+    try:
+        return str(b, 'utf-8')
+    except UnicodeError:
+        return ''.join(chr(c) for c in b)
+
+
+def _grep_pat(pat, sw, raw): # (literal, regex): bytes (raw) or str to find with find()/in when pat has no regex metacharacters, else a compiled re
+    i = sw.get('i')
+    for c in '.^$*+?[]{}()|\\':
+        if c in pat:
+            break
+    else:
+        pat = pat.lower() if i else pat
+        return (pat.encode('utf-8') if raw else pat), None
+    import re
+    if i:
+        if hasattr(re, 'IGNORECASE'):
+            return None, re.compile(pat, re.IGNORECASE)
+        p = '' # MicroPython's re has no flags: lower-case the pattern (but not its \escapes) and each line
+        j = 0
+        while j < len(pat):
+            p += pat[j:j + 2] if pat[j] == '\\' else pat[j].lower()
+            j += 2 if pat[j] == '\\' else 1
+        return None, re.compile(p)
+    return None, re.compile(pat)
+
+
+def _grep_hit(st, sw, name, line): # a selected line; st: [lines before it, lines selected]. True if the file needs no more reading (-l)
+    st[1] += 1
+    if not (sw.get('c') or sw.get('l')):
+        print(f"{name}{st[0]}:{line}" if sw.get('n') else f"{name}{line}")
+    return sw.get('l')
+
+
+def _grep_blk(data, end, st, m, sw, name, cut=False): # the lines in data[:end] (cut: the last one goes on in the next block): literal matches are found with bytes.find over the whole block, only anything else goes line by line
+    lit, rx = m
+    v = bool(sw.get('v'))
+    if lit is not None and not v:
+        hay = data[:end].lower() if sw.get('i') else data
+        pos = last = 0
+        while True:
+            i = hay.find(lit, pos, end)
+            if i < 0:
+                break
+            s = hay.rfind(b'\n', 0, i) + 1
+            e = hay.find(b'\n', i, end)
+            e = end if e < 0 else e
+            st[0] += hay.count(b'\n', last, s) + 1
+            last = e
+            if _grep_hit(st, sw, name, _dec(data[s:e])):
+                return True
+            st[0] -= 1
+            pos = e + 1
+        st[0] += hay.count(b'\n', last, end) + (not cut)
+        return False
+    for line in data[:end].split(b'\n'):
+        st[0] += 1
+        if lit is not None:
+            ok = lit in (line.lower() if sw.get('i') else line)
+        else:
+            s = _dec(line)
+            ok = rx.search(s.lower() if sw.get('i') and not hasattr(rx, 'flags') else s) is not None
+        if ok != v and _grep_hit(st, sw, name, _dec(line)):
+            return True
+    st[0] -= cut
+    return False
+
+
+def _grep_in(m, sw): # grep with no file at the end of a pipe: lines from stdin
+    lit, rx = m
+    st = [0, 0]
+    while True:
+        line = yield
+        if line is None:
+            break
+        line = line.rstrip('\n')
+        st[0] += 1
+        s = line.lower() if sw.get('i') and (lit is not None or not hasattr(rx, 'flags')) else line
+        if (lit in s if lit is not None else rx.search(s) is not None) != bool(sw.get('v')):
+            _grep_hit(st, sw, '', line)
+    if sw.get('c'):
+        print(st[1])
+    elif sw.get('l') and st[1]:
+        print('(standard input)')
+
+
+def grep(shell, cmdenv): # grep [-i] [-v] [-c] [-n] [-l] [-r] pattern [file ...]: streams each file through one buffer, so a file of any size can be searched
+    sw = cmdenv['sw']
+    args = cmdenv['args']
+    if len(args) < 2:
+        shell._ea(cmdenv)  # print("grep: missing operand")
+        return
+    pat = args[1][1:-1] if len(args[1]) > 1 and args[1][0] == args[1][-1] and args[1][0] in '"\'' else args[1] # the shell leaves the quotes on
+    if cmdenv['pipe_from'] is not None and len(args) < 3:
+        return _grep_in(_grep_pat(pat, sw, False), sw)
+    m = _grep_pat(pat, sw, True)
+    paths = args[2:] or (['.'] if sw.get('r') else [])
+    if not paths:
+        shell._ea(cmdenv)  # print("grep: missing file operand")
+        return
+    size = int(shell.os_getenv('SH_RDBUF', 2048))
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    many = len(paths) > 1 or sw.get('r')
+    found = False
+    for top in paths:
+        try:
+            for p, typ, _, _ in shell._walk(top) if sw.get('r') else [(top, 0x8000, 0, 0)]:
+                if typ != 0x8000:
+                    continue
+                name = p[2:] if top == '.' and not args[2:] else p
+                st = [0, 0]
+                try:
+                    with open(p, 'rb') as f:
+                        carry = b''
+                        while True:
+                            n = f.readinto(buf)
+                            if not n:
+                                if carry:
+                                    _grep_blk(carry, len(carry), st, m, sw, f"{name}:" if many else '')
+                                break
+                            data = carry + mv[:n] # (bytes, because a bytearray has no find() in MicroPython)
+                            e = data.rfind(b'\n')
+                            if e < 0 and len(data) < size * 8:
+                                carry = data # no end of line yet
+                                continue
+                            cut = e < 0 # a very long line: search it in pieces (a match across a cut is missed)
+                            e = len(data) if cut else e
+                            carry = data[e + 1:]
+                            if _grep_blk(data, e, st, m, sw, f"{name}:" if many else '', cut):
+                                break
+                except OSError as e:
+                    shell._ee(cmdenv, e)  # print(f"grep: {e}")
+                    continue
+                if sw.get('l') and st[1]:
+                    print(name)
+                elif sw.get('c'):
+                    print(f"{name}:{st[1]}" if many else st[1])
+                found = found or st[1] > 0
+        except OSError as e:
+            shell._ee(cmdenv, e)  # print(f"grep: {e}")
+    if not found:
+        return False # status 1 when nothing was selected, as grep does
+
+
+def _nopt(cmdenv, c, args): # the number given with -c (as -c N or -cN; also -N for -n), from the line: the shell makes -n5 into switches n and 5. The N of -c N is taken out of args
+    tok = cmdenv['line'].split()
+    for i, t in enumerate(tok):
+        if t[:2] == '-' + c and (t[2:].isdigit() or not t[2:]):
+            v = t[2:] or (tok[i + 1] if i + 1 < len(tok) else '')
+            if not t[2:] and v in args:
+                args.remove(v)
+            return v
+        if c == 'n' and t[:1] == '-' and t[1:].isdigit():
+            return t[1:]
+    return None
+
+
+def _send(shell, f, left, size): # send on up to left bytes (-1: all) from where f is, through one buffer
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    while left:
+        n = f.readinto(buf) if left < 0 or left >= size else f.readinto(mv[:left])
+        if not n:
+            break
+        shell.cio.send_bytes(mv[:n])
+        left -= n if left > 0 else 0
+
+
+def _lines_in(n, c, last): # head/tail with no file at the end of a pipe: the first (or last) n lines, or c chars, of stdin
+    keep = []
+    had = 0
+    while True:
+        line = yield
+        if line is None:
+            break
+        if last:
+            keep.append(line)
+            had += len(line)
+            while keep and (len(keep) > n if c is None else had - len(keep[0]) >= c):
+                had -= len(keep.pop(0))
+        elif had < (n if c is None else c): # (the rest is read and dropped, so the stage before can finish)
+            print(line[:c - had] if c is not None else line, end='')
+            had += 1 if c is None else len(line)
+    if keep:
+        s = ''.join(keep)
+        print(s[len(s) - c:] if c is not None else s, end='')
+
+
+def head(shell, cmdenv): # head [-n N] [-c N] [file ...]: reading stops as soon as N lines (10 by default) or N bytes are out
+    args = cmdenv['args'][1:]
+    n = _nopt(cmdenv, 'n', args)
+    c = _nopt(cmdenv, 'c', args)
+    try:
+        n = int(n) if n else 10
+        c = int(c) if c else None
+    except ValueError:
+        shell._ea(cmdenv)  # print("head: missing operand")
+        return
+    if cmdenv['pipe_from'] is not None and not args:
+        return _lines_in(n, c, False)
+    if not args:
+        shell._ea(cmdenv)  # print("head: missing file operand")
+        return
+    size = int(shell.os_getenv('SH_RDBUF', 2048))
+    for path in args:
+        if len(args) > 1:
+            print(f"{'' if path == args[0] else chr(10)}==> {path} <==")
+        try:
+            with open(path, 'rb') as f:
+                if c is not None:
+                    _send(shell, f, c, size)
+                    continue
+                left = n
+                while left > 0:
+                    b = f.read(size) # (bytes: a bytearray has no count() or find() in MicroPython)
+                    if not b:
+                        break
+                    k = b.count(b'\n')
+                    if k >= left: # the end is in this block: find the left'th LF
+                        i = -1
+                        for _ in range(left):
+                            i = b.find(b'\n', i + 1)
+                        b = b[:i + 1]
+                    left -= k
+                    shell.cio.send_bytes(b)
+        except Exception as e:
+            shell._ee(cmdenv, e)  # print(f"head: {e}")
+        finally:
+            shell.cio.send_bytes(None)
+
+
+def _tail_at(f, size, n, bs): # where the last n lines of f start: blocks are read backwards from the end until n LFs are found before them, so the cost is the same for any size of file
+    pos = size
+    while pos > 0:
+        b = min(bs, pos)
+        pos -= b
+        f.seek(pos)
+        blk = f.read(b)
+        i = len(blk)
+        if pos + b == size and blk[-1:] == b'\n':
+            i -= 1 # the file's last LF ends its last line, it doesn't start one
+        while n > 0:
+            i = blk.rfind(b'\n', 0, i)
+            if i < 0:
+                break
+            n -= 1
+        if n == 0:
+            return pos + i + 1
+    return 0
+
+
+def _abs(path):
+    return path if path.startswith('/') else os.getcwd().rstrip('/') + '/' + path
+
+
+def tail(shell, cmdenv): # tail [-n N] [-c N] [-f] [file ...]: the last N lines (10 by default) or bytes; -f then goes on sending what is added to the file (from the idle loop, see CustomIO._follow) until tail --stop
+    args = cmdenv['args'][1:]
+    sw = cmdenv['sw']
+    cio = shell.cio
+    if sw.get('stop'): # stop following (the named files, or all of them) in this session
+        for f in cio.follow[:]:
+            if f[2] is cio.cur and (not args or f[0] in [_abs(a) for a in args]):
+                cio.follow.remove(f)
+        return
+    if sw.get('f') and cio.pipe is not None: # what is added later would have no pipe or file left to go into
+        p, cio.pipe = cio.pipe, None # (so this is seen, not piped on)
+        print(shell.get_desc(93).format(cmdenv['args'][0])) # tail: -f only follows to the terminal, not into a pipe or file
+        cio.pipe = p
+        shell._rc = 1
+        return False
+    n = _nopt(cmdenv, 'n', args)
+    c = _nopt(cmdenv, 'c', args)
+    try:
+        n = int(n) if n else 10
+        c = int(c) if c else None
+    except ValueError:
+        shell._ea(cmdenv)  # print("tail: missing operand")
+        return
+    if cmdenv['pipe_from'] is not None and not args:
+        return _lines_in(n, c, True)
+    if not args:
+        shell._ea(cmdenv)  # print("tail: missing file operand")
+        return
+    bs = int(shell.os_getenv('SH_RDBUF', 2048))
+    k = len(cio.follow)
+    for path in args:
+        if len(args) > 1:
+            print(f"{'' if path == args[0] else chr(10)}==> {path} <==")
+        try:
+            with open(path, 'rb') as f:
+                size = os.stat(path)[6]
+                f.seek(max(0, size - c) if c is not None else _tail_at(f, size, n, bs) if n else size)
+                _send(shell, f, -1, bs)
+                if sw.get('f'):
+                    cio.follow.append([_abs(path), f.tell(), cio.cur, time.ticks_ms()])
+        except Exception as e:
+            shell._ee(cmdenv, e)  # print(f"tail: {e}")
+        finally:
+            cio.send_bytes(None)
+    if len(cio.follow) > k:
+        print(shell.get_desc(92)) # (following; tail --stop to end)
@@ -0,0 +1,33 @@
+# mkcmds.py
+
+# Created by Chris Drake.
+# Build helper for https://github.com/gitcnd/mpy_shell
+#
+# Writes the command->module manifest (sh_cmds.txt) that sh.py uses to import exactly one module per command.
+# One line per command module:  <module>\t<size of the module file in out_dir>\t<space-separated command names>
+# sh.py compares the sizes at runtime and rebuilds the manifest on the device if they no longer match.
+#
+# usage: python3 tools/mkcmds.py <src_dir> <out_dir>    (e.g. lib lib, or lib 1.x/lib)
+
+import ast
+import os
+import sys
+
+
+def main(src_dir, out_dir):
+    mods = sorted(f[:-3] for f in os.listdir(src_dir) if f.startswith('sh') and f[2:-3].isdigit() and f.endswith('.py'))
+    for mod in mods:
+        with open(os.path.join(src_dir, mod + '.py')) as f:
+            tree = ast.parse(f.read())
+        names = sorted(n.name for n in tree.body if isinstance(n, (ast.FunctionDef, ast.ClassDef)) and not n.name.startswith('_')) # same rule and order as sh1._mk_cmds: defined here (not imported), not _private
+        size = -1
+        for ext in ('mpy', 'py'): # same order sh.py checks them in
+            fn = os.path.join(out_dir, f"{mod}.{ext}")
+            if os.path.exists(fn):
+                size = os.path.getsize(fn)
+                break
+        sys.stdout.write(f"{mod}\t{size}\t{' '.join(names)}\n")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])